@@ -0,0 +1,353 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import json
+import random
+import shutil
+import sqlite3
+import argparse
+import tempfile
+import textwrap
+import subprocess
+import timeit
+
+import squid
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows; peak RSS just won't be reported there
+    resource = None
+
+timer = timeit.default_timer
+
+
+def quote(name):
+    return '"{}"'.format(name.replace('"', '""'))
+
+
+def mutate_structure(structure, rng, mutation_rate):
+    """Return a copy of structure with tables and columns randomly dropped, added or retyped."""
+    mutated = {}
+    for table, columns in structure.items():
+        if rng.random() < mutation_rate:
+            continue
+        mutated[table] = {}
+        for column, attributes in columns.items():
+            if rng.random() < mutation_rate:
+                continue
+            attributes = dict(attributes)
+            if rng.random() < mutation_rate:
+                attributes['type'] = rng.choice(['INTEGER', 'TEXT', 'BLOB', 'REAL', 'LONGVARCHAR'])
+            mutated[table][column] = attributes
+        if rng.random() < mutation_rate:
+            mutated[table]['benchmark_column_{}'.format(rng.randint(0, 999))] = \
+                {'type': 'INTEGER', 'not_null': 0, 'default_value': None}
+    return mutated
+
+
+def create_database(path, structure):
+    db = sqlite3.connect(path)
+    for table, columns in structure.items():
+        # SQLite makes its own internal tables (sqlite_sequence, sqlite_stat1, ...) as needed
+        if table.startswith('sqlite_') or not columns:
+            continue
+        column_definitions = []
+        for column, attributes in columns.items():
+            definition = quote(column) + ' ' + (attributes['type'] or '')
+            if attributes['not_null']:
+                definition += ' NOT NULL'
+            if attributes['default_value'] is not None:
+                definition += ' DEFAULT ' + attributes['default_value']
+            column_definitions.append(definition)
+        try:
+            db.execute('CREATE TABLE {} ({})'.format(quote(table), ', '.join(column_definitions)))
+        except sqlite3.DatabaseError:
+            pass
+    db.commit()
+    db.close()
+
+
+def generate_corpus(catalog_path, directory, size, noise, mutation_rate, seed):
+    """Fill directory with size SQLite DBs built from catalog structures, plus noise non-SQLite files.
+
+    Every other DB is an exact copy of a catalog structure and the rest are mutated variants.  The noise files are
+    mostly random bytes, with some starting with a SQLite magic string but a broken header.  The same arguments
+    always produce the same corpus.
+    """
+    rng = random.Random(seed)
+    known_catalog = squid.Catalog(catalog_path)
+    for number in range(size):
+        known_db = known_catalog.entries[number % len(known_catalog)]
+        structure = known_db.structure
+        if number % 2:
+            structure = mutate_structure(structure, rng, mutation_rate)
+        subdirectory = os.path.join(directory, 'db{:03d}'.format(number % 100))
+        if not os.path.isdir(subdirectory):
+            os.makedirs(subdirectory)
+        create_database(os.path.join(subdirectory, '{}_{}'.format(number, known_db.db_name.replace(os.sep, '_'))),
+                        structure)
+
+    noise_directory = os.path.join(directory, 'noise')
+    if noise and not os.path.isdir(noise_directory):
+        os.makedirs(noise_directory)
+    for number in range(noise):
+        with open(os.path.join(noise_directory, 'noise_{}.bin'.format(number)), 'wb') as noise_file:
+            if number % 10 == 0:
+                noise_file.write(squid.SQLITE_HEADER_MAGIC)
+            noise_file.write(''.join(chr(rng.randint(0, 255)) for _ in range(rng.randint(0, 64 * 1024))))
+
+
+def percentiles(samples):
+    """Summarize a list of durations (in seconds) as milliseconds."""
+    if not samples:
+        return {}
+    samples = sorted(samples)
+
+    def percentile(fraction):
+        return 1000 * samples[min(len(samples) - 1, int(fraction * len(samples)))]
+
+    return {'count': len(samples), 'mean_ms': 1000 * sum(samples) / len(samples), 'p50_ms': percentile(0.5),
+            'p90_ms': percentile(0.9), 'p99_ms': percentile(0.99), 'max_ms': 1000 * samples[-1]}
+
+
+def peak_rss_kb(who):
+    if resource is None:
+        return None
+    # ru_maxrss is in kilobytes on Linux but bytes on macOS
+    peak = resource.getrusage(who).ru_maxrss
+    if sys.platform == 'darwin':
+        peak //= 1024
+    return peak
+
+
+def prefilter_recall(candidates, known_catalog, top, settings):
+    """Measure the MinHash/LSH prefilter at each (bands, rows) in settings against the exhaustive rankings.
+
+    recall is the fraction of the exhaustive top matches (those scoring over 0) the prefiltered rankings also have,
+    and best_match_recall the fraction of candidates whose best exhaustive match is still ranked first.
+    """
+    known_catalog.use_prefilter(None)
+    exhaustive = []
+    best_scores = []
+    for candidate in candidates:
+        rankings = squid.compare_to_known(candidate, known_catalog, verbose=False, top=top)
+        exhaustive.append(set(match['squid'].squid_id for match in rankings if match['score'] > 0))
+        best_scores.append(rankings[0]['score'] if rankings else 0.0)
+
+    results = {}
+    for bands, rows in settings:
+        known_catalog.use_prefilter((bands, rows))
+        start = timer()
+        known_catalog.candidates_for({})
+        index_elapsed = timer() - start
+
+        found = best_found = scored = 0
+        start = timer()
+        for candidate, expected, best_score in zip(candidates, exhaustive, best_scores):
+            scored += len(known_catalog.candidates_for(candidate.structure))
+            rankings = squid.compare_to_known(candidate, known_catalog, verbose=False, top=top)
+            found += len(expected & set(match['squid'].squid_id for match in rankings))
+            # Ties for first place count, as any of them could have been ranked first
+            best_found += bool(rankings) and rankings[0]['score'] == best_score
+        elapsed = timer() - start
+        results['{}x{}'.format(bands, rows)] = {
+            'recall': float(found) / max(1, sum(len(expected) for expected in exhaustive)),
+            'best_match_recall': float(best_found) / max(1, len(candidates)),
+            'entries_scored_per_candidate': float(scored) / max(1, len(candidates)),
+            'candidates_per_sec': len(candidates) / elapsed, 'index_build_ms': 1000 * index_elapsed}
+    known_catalog.use_prefilter(None)
+
+    # The same count for the exhaustive ranking, which scores every entry sharing a table with the candidate
+    scored = sum(len(known_catalog.candidates_for(candidate.structure)) for candidate in candidates)
+    results['exhaustive'] = {'recall': 1.0, 'best_match_recall': 1.0,
+                             'entries_scored_per_candidate': float(scored) / max(1, len(candidates))}
+    return results
+
+
+def fuzzy_scoring(candidates, known_catalog, top):
+    """Time fuzzy scoring (--fuzzy) against exact scoring, pair by pair and ranking against the whole catalog.
+
+    The slowdowns are fuzzy time over exact time; best_match_changed is the fraction of candidates whose best
+    match isn't the same entry with fuzzy scoring.
+    """
+    results = {}
+    known_catalog.use_fuzzy(False)
+    start = timer()
+    for candidate in candidates:
+        for known_db in known_catalog:
+            squid.compare_dbs(candidate, known_db)
+    exact_pairs_elapsed = timer() - start
+    start = timer()
+    exact_best = [squid.compare_to_known(candidate, known_catalog, verbose=False, top=top)[0]['squid'].squid_id
+                  for candidate in candidates]
+    exact_ranking_elapsed = timer() - start
+
+    known_catalog.name_similarity = None
+    start = timer()
+    known_catalog.use_fuzzy(True)
+    results['name_index_build_ms'] = 1000 * (timer() - start)
+    name_similarity = known_catalog.fuzzy_names()
+    start = timer()
+    for candidate in candidates:
+        for known_db in known_catalog:
+            squid.compare_dbs_fuzzy(candidate, known_db, name_similarity)
+    fuzzy_pairs_elapsed = timer() - start
+    start = timer()
+    fuzzy_best = [squid.compare_to_known(candidate, known_catalog, verbose=False, top=top)[0]['squid'].squid_id
+                  for candidate in candidates]
+    fuzzy_ranking_elapsed = timer() - start
+    known_catalog.use_fuzzy(False)
+
+    pairs = len(candidates) * len(known_catalog)
+    results.update({
+        'compare_dbs_fuzzy_pairs_per_sec': pairs / fuzzy_pairs_elapsed,
+        'compare_dbs_slowdown': fuzzy_pairs_elapsed / exact_pairs_elapsed,
+        'compare_to_known_candidates_per_sec': len(candidates) / fuzzy_ranking_elapsed,
+        'compare_to_known_slowdown': fuzzy_ranking_elapsed / exact_ranking_elapsed,
+        'best_match_changed': float(sum(exact != fuzzy for exact, fuzzy in zip(exact_best, fuzzy_best))) /
+        max(1, len(candidates))})
+    return results
+
+
+def benchmark(corpus, catalog_path, jobs, top, prefilter_settings):
+    results = {}
+    file_paths = list(squid.walk_files(corpus))
+    known_catalog = squid.load_catalog(catalog_path)
+
+    # Structure extraction, over every file in the corpus
+    durations = []
+    candidates = []
+    start = timer()
+    for file_path in file_paths:
+        candidate = squid.squid(db_name=os.path.basename(file_path), path=file_path)
+        started = timer()
+        candidate.build_structure()
+        durations.append(timer() - started)
+        if candidate.structure != {}:
+            candidates.append(candidate)
+    elapsed = timer() - start
+    results['build_structure'] = dict(percentiles(durations), files_per_sec=len(file_paths) / elapsed)
+
+    # Scoring each candidate against every catalog entry, one pair at a time
+    durations = []
+    start = timer()
+    for candidate in candidates:
+        for known_db in known_catalog:
+            started = timer()
+            squid.compare_dbs(candidate, known_db)
+            durations.append(timer() - started)
+    elapsed = timer() - start
+    results['compare_dbs'] = dict(percentiles(durations), pairs_per_sec=len(durations) / elapsed)
+
+    # Ranking each candidate against the catalog
+    durations = []
+    start = timer()
+    for candidate in candidates:
+        started = timer()
+        squid.compare_to_known(candidate, known_catalog, verbose=False, top=top)
+        durations.append(timer() - started)
+    elapsed = timer() - start
+    results['compare_to_known'] = dict(percentiles(durations), candidates_per_sec=len(candidates) / elapsed)
+
+    # Scoring all the candidates in one batch
+    start = timer()
+    squid.compare_batch(candidates, known_catalog)
+    elapsed = timer() - start
+    results['compare_batch'] = {'count': len(candidates), 'total_ms': 1000 * elapsed,
+                                'candidates_per_sec': len(candidates) / elapsed}
+
+    # Ranking with the MinHash/LSH prefilter, and how many of the exhaustive top matches it keeps
+    results['prefilter'] = prefilter_recall(candidates, known_catalog, top, prefilter_settings)
+    # Scoring with near misses counted, and how much slower it is
+    results['fuzzy'] = fuzzy_scoring(candidates, known_catalog, top)
+    results['benchmark_peak_rss_kb'] = peak_rss_kb(resource.RUSAGE_SELF if resource else None)
+
+    # A full --compare of the corpus, in its own process
+    output_directory = tempfile.mkdtemp(prefix='squid_benchmark_report_')
+    try:
+        command = [sys.executable, os.path.join(os.path.dirname(os.path.realpath(__file__)), 'squid.py'),
+                   '--compare', corpus, '--output', os.path.join(output_directory, 'report'),
+                   '--jobs', str(jobs), '--top', str(top)]
+        with open(os.devnull, 'w') as devnull:
+            start = timer()
+            subprocess.check_call(command, stdout=devnull)
+            elapsed = timer() - start
+    finally:
+        shutil.rmtree(output_directory)
+    results['compare_directory'] = {'files': len(file_paths), 'sqlite_dbs': len(candidates), 'jobs': jobs,
+                                    'total_ms': 1000 * elapsed, 'files_per_sec': len(file_paths) / elapsed,
+                                    'peak_rss_kb': peak_rss_kb(resource.RUSAGE_CHILDREN if resource else None)}
+    return results
+
+
+def git_commit():
+    try:
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=devnull,
+                                           cwd=os.path.dirname(os.path.realpath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def parse_args():
+    description = textwrap.fill("Benchmarks SQUID's structure extraction, scoring and directory compares against a "
+                                "synthetic corpus built from the catalog's own structures, and prints the timings as "
+                                "JSON.  The same --size, --noise, --mutation-rate and --seed always build the same "
+                                "corpus, so runs from different commits can be compared.", width=75,
+                                initial_indent=" ", subsequent_indent="  ")
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter, description=description)
+    parser.add_argument('--corpus',
+                        help='Directory to build the corpus in, or reuse if it already exists.  If not given, a '
+                             'temporary directory is used and removed afterwards.')
+    parser.add_argument('--size', type=int, default=500, help='Number of SQLite DBs in the corpus (default: 500)')
+    parser.add_argument('--noise', type=int, default=500,
+                        help='Number of non-SQLite files in the corpus (default: 500)')
+    parser.add_argument('--mutation-rate', type=float, default=0.1,
+                        help='Chance of each table or column being changed in the mutated DBs (default: 0.1)')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed for building the corpus (default: 0)')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='Number of worker processes for the directory compare (default: 1)')
+    parser.add_argument('-t', '--top', type=int, default=3, help='Number of best matches to rank (default: 3)')
+    parser.add_argument('--prefilter', action='append', metavar='BANDSxROWS',
+                        help='LSH bands and rows to measure the --prefilter recall and speed with, such as 16x2.  '
+                             'Can be given more than once (default: 8x4, 16x2, 32x1)')
+    parser.add_argument('-o', '--output', help='File to write the JSON results to, instead of standard output')
+    args = parser.parse_args()
+    try:
+        args.prefilter = [tuple(int(number) for number in setting.lower().split('x'))
+                          for setting in args.prefilter or ['8x4', '16x2', '32x1']]
+    except ValueError:
+        parser.error('--prefilter takes BANDSxROWS, such as 16x2')
+    return args
+
+
+def main():
+    args = parse_args()
+    # The same catalog squid.py --compare uses
+    catalog_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'catalog.sqlite')
+
+    corpus = args.corpus or tempfile.mkdtemp(prefix='squid_benchmark_')
+    try:
+        if not os.path.isdir(corpus) or not os.listdir(corpus):
+            generate_corpus(catalog_path, corpus, args.size, args.noise, args.mutation_rate, args.seed)
+        results = {'squid_version': squid.__version__, 'commit': git_commit(), 'catalog_entries':
+                   len(squid.load_catalog(catalog_path)),
+                   'corpus': {'size': args.size, 'noise': args.noise, 'mutation_rate': args.mutation_rate,
+                              'seed': args.seed},
+                   'stages': benchmark(corpus, catalog_path, args.jobs, args.top, args.prefilter)}
+    finally:
+        if not args.corpus:
+            shutil.rmtree(corpus)
+
+    report = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            output_file.write(report + '\n')
+    else:
+        print report
+
+
+if __name__ == "__main__":
+    main()
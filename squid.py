@@ -5,9 +5,30 @@ import os
 import sys
 import json
 import time
+import struct
+import re
 import hashlib
+import csv
 import argparse
 import textwrap
+import heapq
+import difflib
+import mmap
+import array
+import collections
+import subprocess
+import Queue
+import select
+import cPickle as pickle
+import contextlib
+import bisect
+import shutil
+import tempfile
+import cProfile
+import multiprocessing
+import threading
+import SocketServer
+import BaseHTTPServer
 import xlsxwriter
 
 __author__ = "Ryan Benson"
@@ -15,6 +36,554 @@ __version__ = "0.5.0"
 __email__ = "ryan@obsidianforensics.com"
 
 
+# The first 100 bytes of a SQLite file are its header, which starts with this magic string
+SQLITE_HEADER_MAGIC = 'SQLite format 3\x00'
+SQLITE_HEADER_SIZE = 100
+
+
+def check_sqlite_header(path):
+    """Read just the header of the file at path and check that it could be a SQLite database.
+
+    Returns None if it looks like one, otherwise a short reason why it was rejected.
+    """
+    try:
+        with open(path, 'rb') as candidate_file:
+            header = candidate_file.read(SQLITE_HEADER_SIZE)
+    except (IOError, OSError):
+        return 'unreadable'
+    return sqlite_header_problem(header)
+
+
+def sqlite_header_problem(header):
+    """Return None if the bytes in header could start a SQLite database, otherwise a short reason why not."""
+    if len(header) < SQLITE_HEADER_SIZE:
+        return 'too small'
+    if header[:16] != SQLITE_HEADER_MAGIC:
+        return 'not SQLite'
+
+    page_size, write_version, read_version, reserved_space, max_payload, min_payload, leaf_payload = \
+        struct.unpack('>HBBBBBB', header[16:24])
+    # The page size is a power of two between 512 and 32768, or 1 for 65536
+    if page_size != 1 and (page_size < 512 or page_size > 32768 or page_size & (page_size - 1)):
+        return 'bad page size'
+    # File format versions are 1 (legacy) or 2 (WAL), and the payload fractions are fixed by the file format
+    if write_version not in (1, 2) or read_version not in (1, 2) or \
+            (max_payload, min_payload, leaf_payload) != (64, 32, 32):
+        return 'bad header'
+    return None
+
+
+# A WAL file starts with a 32-byte header; anything after that is frames SQLite would replay
+WAL_HEADER_SIZE = 32
+# A rollback journal starts with this magic number while it's hot; once committed, its header is zeroed or it's
+# truncated or deleted
+JOURNAL_MAGIC = '\xd9\xd5\x05\xf9\x20\xa1\x63\xd7'
+
+
+class CopiedConnection(sqlite3.Connection):
+    """A connection to a temporary copy of a database; the copy is removed when the connection is closed."""
+
+    def close(self):
+        sqlite3.Connection.close(self)
+        shutil.rmtree(self.copy_directory, ignore_errors=True)
+
+
+def read_only_access(path):
+    """Return how the SQLite db at path can be read without changing it or the files beside it.
+
+    Python 2's sqlite3 module can't open URI filenames (mode=ro, immutable=1), so SQLite can only 'open' the file
+    as-is, with writes turned off.  That still changes a database with a WAL holding frames, which SQLite
+    checkpoints into the file (deleting the -wal file) when the connection closes, and one with a hot journal,
+    which it rolls back: those have to be read from a 'copy'.  A WAL database with nothing in its WAL is read 'raw'
+    from its pages with a RawDatabase instead, as SQLite would still create a -wal and -shm file beside it.
+    """
+    try:
+        with open(path, 'rb') as database_file:
+            header = database_file.read(SQLITE_HEADER_SIZE)
+    except (IOError, OSError):
+        return 'open'
+    try:
+        wal_frames = os.path.getsize(path + '-wal') > WAL_HEADER_SIZE
+    except OSError:
+        wal_frames = False
+    try:
+        with open(path + '-journal', 'rb') as journal_file:
+            hot_journal = journal_file.read(len(JOURNAL_MAGIC)) == JOURNAL_MAGIC
+    except (IOError, OSError):
+        hot_journal = False
+    if wal_frames or hot_journal:
+        return 'copy'
+    # Bytes 18 and 19 of the header are the file format's write and read versions, which are 2 for WAL
+    if '\x02' in header[18:20]:
+        return 'raw'
+    return 'open'
+
+
+def connect_read_only(path, copy=False, copy_directory=None):
+    """Open the SQLite db at path with writes turned off, or a temporary copy of it (with its WAL or journal) if
+    copy is set; see read_only_access.
+
+    The copy is made in copy_directory, or a new temporary directory, which is removed when the connection is
+    closed.  A StructureExtractor gives its process a copy_directory, so it can remove the copy if it has to kill
+    the process part way through.
+    """
+    if not copy:
+        # Never wait on another process's lock; a locked file is read as best it can be, or not at all
+        db = sqlite3.connect(path, timeout=0)
+        db.execute('PRAGMA query_only = ON')
+        return db
+
+    if copy_directory:
+        if not os.path.isdir(copy_directory):
+            os.makedirs(copy_directory)
+    else:
+        copy_directory = tempfile.mkdtemp(prefix='squid-')
+    try:
+        copy_path = os.path.join(copy_directory, 'database')
+        shutil.copyfile(path, copy_path)
+        for suffix in ('-wal', '-journal'):
+            if os.path.exists(path + suffix):
+                shutil.copyfile(path + suffix, copy_path + suffix)
+        db = sqlite3.connect(copy_path, timeout=0, factory=CopiedConnection)
+    except Exception:
+        shutil.rmtree(copy_directory, ignore_errors=True)
+        raise
+    db.copy_directory = copy_directory
+    return db
+
+
+def table_info_per_table(cursor):
+    """Return (table, column, type, not_null, default_value) rows for every table, with a PRAGMA per table.
+
+    A table with no columns gets a single row with the column fields set to None.  Raises sqlite3.Error if the
+    tables couldn't be listed at all.
+    """
+    cursor.execute("SELECT name FROM sqlite_master WHERE type='table'")
+    tables = cursor.fetchall()
+
+    columns = []
+    for table in tables:
+        try:
+            cursor.execute('PRAGMA table_info("{}")'.format(table[0].replace('"', '""')))
+            table_columns = cursor.fetchall()
+        except (sqlite3.DatabaseError, UnicodeError):
+            continue
+        if not table_columns:
+            columns.append((table[0], None, None, None, None))
+        for column in table_columns:
+            columns.append((table[0], column[1], column[2], column[3], column[4]))
+    return columns
+
+
+# Tokens of the SQL in sqlite_master, for reading column definitions out of CREATE TABLE statements without SQLite
+SQL_TOKEN = re.compile(r"""
+    (?P<space>\s+|--[^\n]*|/\*.*?(?:\*/|\Z))
+  | (?P<identifier>"(?:[^"]|"")*"|`(?:[^`]|``)*`|\[[^\]]*\])
+  | (?P<string>[xX]?'(?:[^']|'')*')
+  | (?P<number>0[xX][0-9a-fA-F]+|(?:\d+(?:\.\d*)?|\.\d+)(?:[eE][+-]?\d+)?)
+  | (?P<word>[\w$]+)
+  | (?P<other>.)
+""", re.VERBOSE | re.DOTALL | re.UNICODE)
+
+# Words that end a column's type and start its constraints, and the words that start a table constraint
+COLUMN_CONSTRAINT_WORDS = frozenset(['CONSTRAINT', 'PRIMARY', 'NOT', 'NULL', 'UNIQUE', 'CHECK', 'DEFAULT', 'COLLATE',
+                                     'REFERENCES', 'GENERATED', 'AS'])
+TABLE_CONSTRAINT_WORDS = frozenset(['CONSTRAINT', 'PRIMARY', 'UNIQUE', 'CHECK', 'FOREIGN'])
+# SQLite 3.37+ reports these declared types in upper case, however they were written
+SQLITE_STANDARD_TYPES = frozenset(['ANY', 'BLOB', 'INT', 'INTEGER', 'REAL', 'TEXT'])
+
+
+# The types PRAGMA table_info gives an R*Tree's id, coordinate and auxiliary columns by module, which depend on the
+# SQLite version, so they're read from the running SQLite the first time they're needed
+rtree_column_types = {}
+
+
+def rtree_types(module):
+    """Return the (id, coordinate, auxiliary) column types SQLite reports for an R*Tree table using module."""
+    if module not in rtree_column_types:
+        try:
+            db = sqlite3.connect(':memory:')
+            db.execute('CREATE VIRTUAL TABLE r USING {}(id, x0, x1, +aux)'.format(module))
+            types = [str(row[2]) for row in db.execute('PRAGMA table_info(r)')]
+            db.close()
+            rtree_column_types[module] = (types[0], types[1], types[3])
+        except sqlite3.Error:
+            rtree_column_types[module] = ('', '', '')
+    return rtree_column_types[module]
+
+
+def dequote(name):
+    """Strip the quotes SQLite allows around a name ("x", [x], `x` or 'x'), undoubling any inside it."""
+    if name[:1] == '[':
+        return name[1:name.find(']')]
+    if name[:1] in ('"', "'", '`'):
+        quote = name[0]
+        end = 1
+        while True:
+            end = name.find(quote, end)
+            if end == -1 or name[end + 1:end + 2] != quote:
+                return name[1:end].replace(quote * 2, quote)
+            end += 2
+    return name
+
+
+def parse_create_table(sql):
+    """Return a (column, type, not_null, default_value) tuple per column declared in a CREATE TABLE statement.
+
+    The values are what PRAGMA table_info would report for the table, and generated columns are left out as they
+    are there.  Virtual tables just get their module arguments' names, with no types.  Returns None if sql doesn't
+    have a column list at all.
+    """
+    tokens = [(match.lastgroup, match.group(), match.start(), match.end()) for match in SQL_TOKEN.finditer(sql)
+              if match.lastgroup != 'space']
+    words = [text.upper() if kind == 'word' else text for kind, text, start, end in tokens]
+    if '(' not in words:
+        return None
+    virtual = 'VIRTUAL' in words[:words.index('(')]
+    module = words[words.index('USING') + 1].lower() if virtual and 'USING' in words[:words.index('(') - 1] else None
+
+    # Split the column list into definitions at its top-level commas
+    definitions = [[]]
+    depth = 0
+    position = words.index('(') + 1
+    while position < len(tokens):
+        word = words[position]
+        if word == '(':
+            depth += 1
+        elif word == ')':
+            if depth == 0:
+                break
+            depth -= 1
+        elif word == ',' and depth == 0:
+            definitions.append([])
+            position += 1
+            continue
+        definitions[-1].append(position)
+        position += 1
+    without_rowid = words[position + 1:position + 3] == ['WITHOUT', 'ROWID']
+
+    columns = []
+    primary_key = set()
+    for definition in definitions:
+        if not definition:
+            continue
+        first = definition[0]
+        if virtual:
+            # Module arguments are either column names (possibly with options) or key=value settings
+            if '=' in [words[i] for i in definition] or words[first] == 'TOKENIZE':
+                continue
+            column_type = ''
+            if module in ('rtree', 'rtree_i32'):
+                # R*Tree auxiliary columns start with a +; the first column is the id and the rest coordinates
+                id_type, coordinate_type, auxiliary_type = rtree_types(module)
+                column_type = id_type if not columns else coordinate_type
+                if words[first] == '+' and len(definition) > 1:
+                    first = definition[1]
+                    column_type = auxiliary_type
+            columns.append((dequote(tokens[first][1]), column_type, 0, None))
+            continue
+        if words[first] in TABLE_CONSTRAINT_WORDS:
+            definition_words = [words[i] for i in definition]
+            # A constraint cut off before its column list (in a damaged or carved schema) has no columns to add
+            if 'PRIMARY' in definition_words and '(' in definition_words:
+                # PRIMARY KEY (a, b COLLATE x DESC, ...); the first name of each part is a column
+                start = definition_words.index('(') + 1
+                expect_name = True
+                for i in definition[start:]:
+                    if words[i] == ',':
+                        expect_name = True
+                    elif expect_name and tokens[i][0] in ('word', 'identifier', 'string'):
+                        primary_key.add(dequote(tokens[i][1]).lower())
+                        expect_name = False
+            continue
+
+        name = dequote(tokens[first][1])
+        # The type is every token up to the first constraint, as written
+        type_end = 1
+        depth = 0
+        while type_end < len(definition):
+            word = words[definition[type_end]]
+            if depth == 0 and word in COLUMN_CONSTRAINT_WORDS:
+                break
+            depth += (word == '(') - (word == ')')
+            type_end += 1
+        column_type = ''
+        if type_end > 1:
+            column_type = sql[tokens[definition[1]][2]:tokens[definition[type_end - 1]][3]]
+            if column_type.upper() in SQLITE_STANDARD_TYPES and sqlite3.sqlite_version_info >= (3, 37):
+                column_type = column_type.upper()
+            else:
+                column_type = dequote(column_type)
+
+        not_null = 0
+        default_value = None
+        generated = False
+        depth = 0
+        i = type_end
+        while i < len(definition):
+            word = words[definition[i]]
+            if word == '(':
+                depth += 1
+            elif word == ')':
+                depth -= 1
+            elif depth == 0:
+                following = words[definition[i + 1]] if i + 1 < len(definition) else None
+                if word == 'NOT' and following == 'NULL':
+                    not_null = 1
+                elif word == 'PRIMARY':
+                    primary_key.add(name.lower())
+                elif word in ('GENERATED', 'AS'):
+                    generated = True
+                elif word == 'DEFAULT' and following is not None and words[definition[i - 1]] != 'SET':
+                    # DEFAULT is a literal, a signed number, a name, or a parenthesized expression
+                    if following == '(':
+                        close = i + 1
+                        nesting = 0
+                        while close < len(definition):
+                            nesting += (words[definition[close]] == '(') - (words[definition[close]] == ')')
+                            if nesting == 0:
+                                break
+                            close += 1
+                        close = min(close, len(definition) - 1)
+                        default_value = sql[tokens[definition[i + 1]][3]:tokens[definition[close]][2]].strip()
+                        i = close
+                    else:
+                        last = i + 1
+                        if following in ('+', '-') and i + 2 < len(definition):
+                            last = i + 2
+                        default_value = sql[tokens[definition[i + 1]][2]:tokens[definition[last]][3]]
+                        i = last
+            i += 1
+        if not generated:
+            columns.append((name, column_type, not_null, default_value))
+
+    if without_rowid:
+        columns = [(name, column_type, 1 if name.lower() in primary_key else not_null, default_value)
+                   for name, column_type, not_null, default_value in columns]
+    return columns
+
+
+def read_varint(data, offset):
+    """Return the SQLite varint at offset in data, and the offset just past it."""
+    value = 0
+    for i in range(8):
+        byte = ord(data[offset + i])
+        value = (value << 7) | (byte & 0x7f)
+        if byte < 0x80:
+            return value, offset + i + 1
+    return (value << 8) | ord(data[offset + 8]), offset + 9
+
+
+def decode_record(payload, encoding):
+    """Return the list of values in a SQLite record."""
+    header_size, offset = read_varint(payload, 0)
+    serial_types = []
+    while offset < header_size:
+        serial_type, offset = read_varint(payload, offset)
+        serial_types.append(serial_type)
+
+    values = []
+    offset = header_size
+    for serial_type in serial_types:
+        if serial_type >= 12:
+            size = (serial_type - 12) // 2
+            value = payload[offset:offset + size]
+            if len(value) < size:
+                raise ValueError('record is truncated')
+            if serial_type % 2:
+                value = value.decode(encoding)
+        elif 1 <= serial_type <= 6:
+            size = (0, 1, 2, 3, 4, 6, 8)[serial_type]
+            value = 0
+            for byte in payload[offset:offset + size]:
+                value = (value << 8) | ord(byte)
+            if value >= 1 << (size * 8 - 1):
+                value -= 1 << (size * 8)
+        elif serial_type == 7:
+            size = 8
+            value = struct.unpack('>d', payload[offset:offset + 8])[0]
+        elif serial_type in (0, 8, 9):
+            size = 0
+            value = {0: None, 8: 0, 9: 1}[serial_type]
+        else:
+            raise ValueError('bad serial type')
+        values.append(value)
+        offset += size
+    return values
+
+
+# What reading the pages of a damaged or truncated database can raise
+RAW_DATABASE_ERRORS = (ValueError, IndexError, TypeError, struct.error)
+
+
+class RawDatabase(object):
+    """Reads records straight from the pages of a SQLite database in a buffer (such as an mmap), without SQLite.
+
+    The database starts at offset in buffer.  Page numbers past the end of the buffer, or past the database size
+    in its header when that is known to be valid, raise a ValueError, as do pages that don't parse.
+    """
+
+    def __init__(self, buffer, offset=0):
+        self.buffer = buffer
+        self.offset = offset
+        header = buffer[offset:offset + SQLITE_HEADER_SIZE]
+        problem = sqlite_header_problem(header)
+        if problem:
+            raise ValueError(problem)
+
+        self.page_size = struct.unpack('>H', header[16:18])[0]
+        if self.page_size == 1:
+            self.page_size = 65536
+        self.usable_size = self.page_size - ord(header[20])
+        self.encoding = {2: 'utf-16-le', 3: 'utf-16-be'}.get(struct.unpack('>I', header[56:60])[0], 'utf-8')
+        self.page_count = (len(buffer) - offset) // self.page_size
+        # The database size in the header is only valid if it was written by a SQLite that keeps it up to date
+        change_counter, header_page_count = struct.unpack('>II', header[24:32])
+        if header_page_count and change_counter == struct.unpack('>I', header[92:96])[0]:
+            self.page_count = min(self.page_count, header_page_count)
+
+    def page(self, page_number):
+        if not 1 <= page_number <= self.page_count:
+            raise ValueError('page {} is out of range'.format(page_number))
+        start = self.offset + (page_number - 1) * self.page_size
+        return self.buffer[start:start + self.page_size]
+
+    def cell_payload(self, page, offset):
+        """Return the payload of the table b-tree leaf cell at offset in page, following any overflow pages."""
+        payload_size, offset = read_varint(page, offset)
+        rowid, offset = read_varint(page, offset)
+        # How much of the payload is stored on the page itself is fixed by the file format
+        most_local = self.usable_size - 35
+        if payload_size <= most_local:
+            return page[offset:offset + payload_size]
+        least_local = (self.usable_size - 12) * 32 // 255 - 23
+        local_size = least_local + (payload_size - least_local) % (self.usable_size - 4)
+        if local_size > most_local:
+            local_size = least_local
+
+        parts = [page[offset:offset + local_size]]
+        remaining = payload_size - local_size
+        overflow_page = struct.unpack('>I', page[offset + local_size:offset + local_size + 4])[0]
+        seen = set()
+        while remaining > 0:
+            if overflow_page in seen:
+                raise ValueError('overflow pages loop')
+            seen.add(overflow_page)
+            data = self.page(overflow_page)
+            parts.append(data[4:4 + min(remaining, self.usable_size - 4)])
+            remaining -= self.usable_size - 4
+            overflow_page = struct.unpack('>I', data[:4])[0]
+        return ''.join(parts)
+
+    def table_records(self, root_page):
+        """Yield the records in the table b-tree rooted at root_page, in rowid order."""
+        pages = [root_page]
+        seen = set()
+        while pages:
+            page_number = pages.pop()
+            if page_number in seen:
+                raise ValueError('b-tree pages loop')
+            seen.add(page_number)
+            page = self.page(page_number)
+            # Page 1 starts with the database header
+            header_offset = SQLITE_HEADER_SIZE if page_number == 1 else 0
+            page_type, cell_count = ord(page[header_offset]), struct.unpack('>H', page[header_offset + 3:
+                                                                                      header_offset + 5])[0]
+            if page_type == 0x05:
+                cell_pointers = struct.unpack('>{}H'.format(cell_count),
+                                              page[header_offset + 12:header_offset + 12 + 2 * cell_count])
+                children = [struct.unpack('>I', page[pointer:pointer + 4])[0] for pointer in cell_pointers]
+                children.append(struct.unpack('>I', page[header_offset + 8:header_offset + 12])[0])
+                pages.extend(reversed(children))
+            elif page_type == 0x0d:
+                cell_pointers = struct.unpack('>{}H'.format(cell_count),
+                                              page[header_offset + 8:header_offset + 8 + 2 * cell_count])
+                for pointer in cell_pointers:
+                    yield decode_record(self.cell_payload(page, pointer), self.encoding)
+            else:
+                raise ValueError('page {} is not a table b-tree page'.format(page_number))
+
+    def structure(self):
+        """Return the structure of the database, as built from the CREATE TABLE statements in sqlite_master."""
+        return structure_from_schema(self.table_records(1))
+
+    def recover_schema(self):
+        """Return whatever sqlite_master records can be read from a damaged database.
+
+        The sqlite_master b-tree is walked as far as it can be.  If that fails part way, every table b-tree leaf page
+        in the database is searched for cells holding records that look like sqlite_master ones as well, which
+        finds the schema even when page 1 or the interior pages are gone.
+        """
+        records = []
+        try:
+            for record in self.table_records(1):
+                records.append(record)
+            return records
+        except RAW_DATABASE_ERRORS:
+            pass
+
+        names = set(record[1] for record in records if len(record) > 1)
+        # A sqlite_master record starts with a one-byte header size, then the serial type of its type text
+        type_texts = [schema_type.encode(self.encoding) for schema_type in SCHEMA_TYPES]
+        type_serials = set(chr(13 + 2 * len(type_text)) for type_text in type_texts)
+        for page_number in range(1, self.page_count + 1):
+            start = self.offset + (page_number - 1) * self.page_size
+            header_offset = SQLITE_HEADER_SIZE if page_number == 1 else 0
+            # Only table b-tree leaf pages hold records; checking the page type first saves reading the rest
+            if self.buffer[start + header_offset] != '\x0d':
+                continue
+            page = self.page(page_number)
+            # The type text is always in the part of a record kept on the page, even when the rest overflows
+            if not any(type_text in page for type_text in type_texts):
+                continue
+            cell_count = struct.unpack('>H', page[header_offset + 3:header_offset + 5])[0]
+            for cell in range(cell_count):
+                try:
+                    pointer = struct.unpack('>H', page[header_offset + 8 + 2 * cell:header_offset + 10 + 2 * cell])[0]
+                    payload_offset = read_varint(page, read_varint(page, pointer)[1])[1]
+                    if page[payload_offset + 1] not in type_serials:
+                        continue
+                    record = decode_record(self.cell_payload(page, pointer), self.encoding)
+                except RAW_DATABASE_ERRORS:
+                    continue
+                if len(record) == 5 and record[0] in SCHEMA_TYPES and isinstance(record[4], unicode) and \
+                        record[4][:6].upper() == 'CREATE' and record[1] not in names:
+                    names.add(record[1])
+                    records.append(record)
+        return records
+
+
+# The types of objects in sqlite_master
+SCHEMA_TYPES = frozenset(['table', 'index', 'view', 'trigger'])
+
+
+def structure_from_schema(schema_records):
+    """Build a structure like squid.build_structure does from (type, name, tbl_name, rootpage, sql) records.
+
+    A table whose CREATE TABLE statement can't be parsed (such as one garbled in a damaged file) is kept with no
+    columns, rather than losing the rest of the schema.
+    """
+    structure = {}
+    for record in schema_records:
+        if len(record) < 5 or record[0] != 'table' or not isinstance(record[1], basestring):
+            continue
+        try:
+            columns = parse_create_table(record[4]) if isinstance(record[4], basestring) else None
+        except (ValueError, IndexError, TypeError):
+            columns = None
+        try:
+            table = structure.setdefault(str(record[1]), {})
+        except UnicodeError:
+            continue
+        for column_name, column_type, not_null, default_value in columns or ():
+            try:
+                table[str(column_name)] = {'type': str(column_type), 'not_null': not_null,
+                                           'default_value': default_value}
+            except UnicodeError:
+                continue
+    return structure
+
+
 def dict_factory(cursor, row):
     d = {}
     for idx, col in enumerate(cursor.description):
@@ -22,6 +591,134 @@ def dict_factory(cursor, row):
     return d
 
 
+# Upper bounds, in milliseconds, of the buckets in each stage's timing histogram; the last bucket has no bound
+STAGE_HISTOGRAM_BOUNDS = [0.1, 1, 10, 100, 1000, 10000]
+# Number of failures kept with their full details in the metrics; the rest are only counted
+FAILURE_SAMPLES_SIZE = 1000
+
+
+class ScanMetrics(object):
+    """Counts and times each stage of a scan (walk, sniff, connect, extract, recover, score, report), with a
+    histogram of the times for each, and keeps the reasons files couldn't be read.
+
+    Worker processes send their metrics back with take() to be merge()d into the main process's.  If
+    start_profiling() is called, ranking is run under cProfile and the profile is written by save_profile().
+    """
+
+    def __init__(self):
+        self.profile_path = None
+        self.profiler = None
+        self.reset()
+
+    def reset(self):
+        self.started = time.time()
+        self.stages = {}
+        self.counters = collections.Counter()
+        self.failures = collections.Counter()
+        self.failure_samples = []
+        self.current_path = None
+
+    def record(self, stage, seconds):
+        if stage not in self.stages:
+            self.stages[stage] = [0, 0.0, [0] * (len(STAGE_HISTOGRAM_BOUNDS) + 1)]
+        timings = self.stages[stage]
+        timings[0] += 1
+        timings[1] += seconds
+        timings[2][bisect.bisect_left(STAGE_HISTOGRAM_BOUNDS, seconds * 1000)] += 1
+
+    @contextlib.contextmanager
+    def timing(self, stage):
+        started = time.time()
+        try:
+            yield
+        finally:
+            self.record(stage, time.time() - started)
+
+    def record_failure(self, path, stage, error, seconds):
+        reason = '{}: {}'.format(stage, type(error).__name__)
+        self.failures[reason] += 1
+        if len(self.failure_samples) < FAILURE_SAMPLES_SIZE:
+            self.failure_samples.append({'path': path, 'reason': reason, 'error': str(error), 'seconds': seconds})
+
+    def take(self):
+        """Return the metrics gathered so far, as merge() takes them, and start counting again."""
+        taken = {'stages': self.stages, 'counters': self.counters, 'failures': self.failures,
+                 'failure_samples': self.failure_samples}
+        self.stages = {}
+        self.counters = collections.Counter()
+        self.failures = collections.Counter()
+        self.failure_samples = []
+        return taken
+
+    def merge(self, taken):
+        for stage, (count, seconds, histogram) in taken['stages'].items():
+            if stage not in self.stages:
+                self.stages[stage] = [0, 0.0, [0] * (len(STAGE_HISTOGRAM_BOUNDS) + 1)]
+            timings = self.stages[stage]
+            timings[0] += count
+            timings[1] += seconds
+            timings[2] = [mine + theirs for mine, theirs in zip(timings[2], histogram)]
+        self.counters.update(taken['counters'])
+        self.failures.update(taken['failures'])
+        self.failure_samples.extend(taken['failure_samples'][:FAILURE_SAMPLES_SIZE - len(self.failure_samples)])
+
+    def summary(self):
+        elapsed = time.time() - self.started
+        labels = ['<={}ms'.format(bound) for bound in STAGE_HISTOGRAM_BOUNDS] + \
+                 ['>{}ms'.format(STAGE_HISTOGRAM_BOUNDS[-1])]
+        stages = {}
+        for stage, (count, seconds, histogram) in self.stages.items():
+            stages[stage] = {'count': count, 'total_seconds': seconds,
+                             'mean_ms': 1000 * seconds / count if count else 0.0,
+                             'histogram': dict(zip(labels, histogram))}
+        return {'squid_version': __version__, 'elapsed_seconds': elapsed, 'counters': dict(self.counters),
+                'files_per_second': self.counters['files'] / elapsed if elapsed else 0.0, 'stages': stages,
+                'failures': dict(self.failures), 'failure_samples': self.failure_samples}
+
+    def start_profiling(self, profile_path):
+        self.profile_path = profile_path
+        self.profiler = cProfile.Profile()
+
+    @contextlib.contextmanager
+    def profiling(self):
+        if self.profiler:
+            self.profiler.enable()
+        try:
+            yield
+        finally:
+            if self.profiler:
+                self.profiler.disable()
+
+    def save_profile(self):
+        if self.profiler:
+            self.profiler.dump_stats(self.profile_path)
+
+
+# The metrics of the scan this process is running
+scan_metrics = ScanMetrics()
+
+# Number of SQLite virtual machine instructions between checks that reading a file hasn't run over its time limit
+PROGRESS_HANDLER_STEPS = 10000
+
+
+class FileLimits(object):
+    """The most time reading one file's structure may take, in seconds, and the most tables and columns it may
+    have; a limit of None (or 0) isn't enforced.
+    """
+
+    def __init__(self, seconds=None, tables=None, columns=None):
+        self.seconds = seconds
+        self.tables = tables
+        self.columns = columns
+
+    def __repr__(self):
+        return 'FileLimits({!r}, {!r}, {!r})'.format(self.seconds, self.tables, self.columns)
+
+
+class LimitExceeded(Exception):
+    pass
+
+
 class squid(object):
     def __init__(self, db_name=None, structure={}, path=None, program_family=None, program_name=None, program_version=None, squid_id=None):
         self.db_name = db_name
@@ -31,57 +728,174 @@ class squid(object):
         self.program_name = program_name
         self.program_version = program_version
         self.squid_id = squid_id
+        self.rejected = None
+        self.partial = False
+        self.limit_exceeded = None
 
-    def build_structure(self):
+    def build_structure(self, limits=None, header_checked=False, copy_directory=None):
 
         self.structure = {}
+        deadline = time.time() + limits.seconds if limits and limits.seconds else None
+
+        # Check the file's header before paying for a connection; most files in a scan aren't SQLite DBs at all
+        if not header_checked:
+            with scan_metrics.timing('sniff'):
+                self.rejected = check_sqlite_header(self.path)
+            if self.rejected:
+                return
 
-        # Connect to SQLite db
+        # Connect to SQLite db, unless that would change it
+        access = read_only_access(self.path)
+        if access == 'raw':
+            self.read_raw_structure(limits)
+            return
+        started = time.time()
         try:
-            db = sqlite3.connect(self.path)
-            cursor = db.cursor()
-        except:
+            with scan_metrics.timing('connect'):
+                db = connect_read_only(self.path, access == 'copy', copy_directory)
+                cursor = db.cursor()
+                if deadline:
+                    # Returning True from the progress handler interrupts the statement SQLite is running
+                    db.set_progress_handler(lambda: time.time() > deadline, PROGRESS_HANDLER_STEPS)
+        except Exception as error:
+            self.record_failure('connect', error, started)
+            self.recover_structure(limits)
             return
 
-        # Find the names of each table in the db
-        try:
-            cursor.execute("SELECT name FROM sqlite_master WHERE type='table'")
-            tables = cursor.fetchall()
-        except sqlite3.OperationalError:
-            # print("\nSQLite3 error; is the file open?  If so, please close it and try again.")
+        # Find each table in the db and all the columns in it.  This is a single query with the pragma_table_info()
+        # table-valued function (SQLite 3.16+); on older SQLite builds, or if the query fails (such as on a virtual
+        # table whose module isn't available), fall back to running PRAGMA table_info on each table.
+        started = time.time()
+        with scan_metrics.timing('extract'):
+            try:
+                if limits and limits.tables:
+                    cursor.execute("SELECT count(*) FROM sqlite_master WHERE type = 'table'")
+                    self.check_limits(limits, cursor.fetchone()[0], 0, started)
+                try:
+                    cursor.execute("SELECT m.name, p.name, p.type, p.\"notnull\", p.dflt_value FROM sqlite_master AS m "
+                                   "LEFT JOIN pragma_table_info(m.name) AS p WHERE m.type = 'table'")
+                    columns = []
+                    while not self.limit_exceeded:
+                        rows = cursor.fetchmany(1000)
+                        if not rows:
+                            break
+                        columns += rows
+                        self.check_limits(limits, 0, len(columns), started)
+                except sqlite3.DatabaseError:
+                    if self.limit_exceeded or deadline and time.time() > deadline:
+                        raise
+                    columns = table_info_per_table(cursor)
+                    self.check_limits(limits, 0, len(columns), started)
+            except Exception as error:
+                if deadline and time.time() > deadline:
+                    self.exceed_limit('timed out', 'took over {}s'.format(limits.seconds), started)
+                else:
+                    self.record_failure('extract', error, started)
+                columns = None
+            db.close()
+        if self.limit_exceeded:
             return
-        except:
-            # print "Couldn't open {}".format(self.path)
+        if columns is None:
+            # SQLite couldn't read the schema at all, which usually means the file is damaged or only partly carved
+            self.recover_structure(limits)
             return
 
-        # For each table, find all the columns in it
-        for table in tables:
+        # Create a dict of dicts of the table/column names and column attributes
+        for table_name, column_name, column_type, not_null, default_value in columns:
             try:
-                cursor.execute('PRAGMA table_info({})'.format(str(table[0])))
-                columns = cursor.fetchall()
-                # print columns
-
-                # Create a dict of lists of the table/column names
-                self.structure[str(table[0])] = {}
-                for column in columns:
-                    self.structure[str(table[0])][str(column[1])] = {}
-                    self.structure[str(table[0])][str(column[1])]['type'] = str(column[2])
-                    self.structure[str(table[0])][str(column[1])]['not_null'] = column[3]
-                    self.structure[str(table[0])][str(column[1])]['default_value'] = column[4]
-            except:
+                table = self.structure.setdefault(str(table_name), {})
+                if column_name is not None:
+                    table[str(column_name)] = {'type': str(column_type), 'not_null': not_null,
+                                               'default_value': default_value}
+            except UnicodeError:
+                continue
+
+    def read_raw_structure(self, limits=None):
+        """Build the structure from the CREATE TABLE statements in the file's own pages, without SQLite."""
+        started = time.time()
+        with scan_metrics.timing('extract'):
+            try:
+                with open(self.path, 'rb') as database_file:
+                    buffer = mmap.mmap(database_file.fileno(), 0, access=mmap.ACCESS_READ)
+            except (IOError, OSError, mmap.error) as error:
+                self.record_failure('extract', error, started)
+                return
+            try:
+                self.structure = RawDatabase(buffer).structure()
+            except RAW_DATABASE_ERRORS as error:
+                self.record_failure('extract', error, started)
+                self.structure = None
+            finally:
+                buffer.close()
+        if self.structure is None:
+            self.recover_structure(limits)
+            return
+        self.check_limits(limits, len(self.structure), sum(len(table) for table in self.structure.values()),
+                          started)
+        if self.limit_exceeded:
+            self.structure = {}
+
+    def recover_structure(self, limits=None):
+        """Build what structure can be read from the raw pages of a file SQLite can't open, and mark it partial."""
+        started = time.time()
+        with scan_metrics.timing('recover'):
+            try:
+                with open(self.path, 'rb') as damaged_file:
+                    buffer = mmap.mmap(damaged_file.fileno(), 0, access=mmap.ACCESS_READ)
+            except (IOError, OSError, mmap.error) as error:
+                self.record_failure('recover', error, started)
                 return
+            try:
+                self.structure = structure_from_schema(RawDatabase(buffer).recover_schema())
+            except RAW_DATABASE_ERRORS as error:
+                self.record_failure('recover', error, started)
+                self.structure = {}
+            finally:
+                buffer.close()
+        self.partial = self.structure != {}
+        self.check_limits(limits, len(self.structure), sum(len(table) for table in self.structure.values()),
+                          started)
+        if self.limit_exceeded:
+            self.structure = {}
+            self.partial = False
+
+    def check_limits(self, limits, tables, columns, started):
+        """Mark this file oversized if it has more tables or columns than limits allows."""
+        if not limits or self.limit_exceeded:
+            return
+        if limits.tables and tables > limits.tables:
+            self.exceed_limit('oversized', 'over {} tables'.format(limits.tables), started)
+        elif limits.columns and columns > limits.columns:
+            self.exceed_limit('oversized', 'over {} columns'.format(limits.columns), started)
+
+    def exceed_limit(self, status, reason, started):
+        self.limit_exceeded = status
+        scan_metrics.counters[status] += 1
+        self.record_failure('limits', LimitExceeded(reason), started)
+
+    def record_failure(self, stage, error, started):
+        """Note in the scan metrics why reading this file failed at stage, and how long it had taken."""
+        scan_metrics.record_failure(self.path, stage, error, time.time() - started)
+
+
+# These values are used to compute how similar two databases are, based on how many tables, columns, and column
+# attributes are shared between them.  These initial values are set to give table name matches the most weight at
+# 12, each column name match half that weight at 6, and all three attributes total a weight of 3 (1 each).  These
+# weights can be modified as you see fit to tweak the comparison equation.
+TABLE_WEIGHT = 12
+COLUMN_WEIGHT = 6
+# SQUID considers three attributes for each column: type, default_value, and not_null.
+ATTRIBUTE_WEIGHT = 1
+ATTRIBUTES = ['type', 'default_value', 'not_null']
+
+# Number of files handed to compare_files at a time when scanning a directory
+COMPARE_BATCH_SIZE = 32
+# Number of distinct structures whose rankings compare_files remembers for the rest of a scan
+RANKED_STRUCTURES_SIZE = 10000
 
 
 def compare_dbs(candidate, known):
-    # These values are used to compute how similar two databases are, based on how many tables, columns, and column
-    # attributes are shared between them.  These initial values are set to give table name matches the most weight at
-    # 12, each column name match half that weight at 6, and all three attributes total a weight of 3 (1 each).  These
-    # weights can be modified as you see fit to tweak the comparison equation.
-    TABLE_WEIGHT = 12
-    COLUMN_WEIGHT = 6
-    # SQUID considers three attributes for each column: type, default_value, and not_null.
-    ATTRIBUTE_WEIGHT = 1
-    attributes = ['type', 'default_value', 'not_null']
+    attributes = ATTRIBUTES
     # Initialize both the scores to 0.
     candidate_score = 0
     known_score = 0
@@ -130,12 +944,851 @@ def compare_dbs(candidate, known):
     return candidate_score, known_score, "{:.1f}".format(100 * float(candidate_score) / known_score)
 
 
+# Names at least this similar (by difflib's ratio, ignoring case) are scored as near misses by compare_dbs_fuzzy
+FUZZY_NAME_THRESHOLD = 0.8
+# Number of names' near misses, and of pairs of names' similarities, each NameSimilarity remembers
+NAME_SIMILARITY_CACHE_SIZE = 100000
+
+
+def type_affinity(declared_type):
+    """Return the affinity SQLite gives a column of declared_type, by the rules SQLite itself uses."""
+    declared_type = (declared_type or '').upper()
+    if 'INT' in declared_type:
+        return 'INTEGER'
+    if 'CHAR' in declared_type or 'CLOB' in declared_type or 'TEXT' in declared_type:
+        return 'TEXT'
+    if 'BLOB' in declared_type or not declared_type:
+        return 'BLOB'
+    if 'REAL' in declared_type or 'FLOA' in declared_type or 'DOUB' in declared_type:
+        return 'REAL'
+    return 'NUMERIC'
+
+
+def name_bigrams(name):
+    padded = '\x00' + name.lower() + '\x00'
+    return set(padded[index:index + 2] for index in range(len(padded) - 1))
+
+
+class NameSimilarity(object):
+    """How similar names are, by difflib's ratio ignoring case, remembered in bounded LRUs shared by every
+    comparison against a catalog.
+
+    similar() finds the near misses for a name among a vocabulary (the catalog's table names), looking only at the
+    names sharing enough character bigrams with it; the near misses for every name in the vocabulary are worked
+    out up front.  ratio() compares any two names, and near_misses() uses whichever fits.
+    """
+
+    def __init__(self, vocabulary, threshold=FUZZY_NAME_THRESHOLD, size=NAME_SIMILARITY_CACHE_SIZE):
+        self.threshold = threshold
+        self.size = size
+        self.bigrams = {}
+        self.bigram_index = {}
+        for name in vocabulary:
+            self.bigrams[name] = name_bigrams(name)
+            for bigram in self.bigrams[name]:
+                self.bigram_index.setdefault(bigram, []).append(name)
+        self.similarities = collections.OrderedDict()
+        self.ratios = collections.OrderedDict()
+        for name in vocabulary:
+            self.similar(name)
+
+    def remember(self, memo, key, value):
+        memo[key] = value
+        while len(memo) > self.size:
+            memo.popitem(last=False)
+        return value
+
+    def similar(self, name):
+        """Return {vocabulary name: similarity} for the other names in the vocabulary near enough to name."""
+        if name in self.similarities:
+            near_misses = self.similarities.pop(name)
+            self.similarities[name] = near_misses
+            return near_misses
+
+        # Names with too few bigrams in common can't reach the threshold, so they aren't compared at all
+        bigrams = name_bigrams(name)
+        shared = collections.Counter()
+        for bigram in bigrams:
+            shared.update(self.bigram_index.get(bigram, ()))
+        matcher = difflib.SequenceMatcher(None, '', name.lower())
+        near_misses = {}
+        for other, shared_count in shared.items():
+            if other == name or 2.0 * shared_count / (len(bigrams) + len(self.bigrams[other])) < self.threshold - 0.2:
+                continue
+            matcher.set_seq1(other.lower())
+            if matcher.real_quick_ratio() >= self.threshold and matcher.quick_ratio() >= self.threshold:
+                similarity = matcher.ratio()
+                if similarity >= self.threshold:
+                    near_misses[other] = similarity
+        return self.remember(self.similarities, name, near_misses)
+
+    def near_misses(self, name, others):
+        """Return {other: similarity} for the names in others near enough to name."""
+        similar = self.similar(name)
+        near_misses = {}
+        for other in others:
+            similarity = similar.get(other) if other in self.bigrams else self.ratio(name, other)
+            if similarity:
+                near_misses[other] = similarity
+        return near_misses
+
+    def ratio(self, name, other):
+        """Return how similar name and other are, or 0.0 if they aren't near enough to count."""
+        # The ratio can't be more than this, so names of very different lengths needn't be looked at
+        if 2.0 * min(len(name), len(other)) < self.threshold * (len(name) + len(other)):
+            return 0.0
+        key = (name, other)
+        if key in self.ratios:
+            similarity = self.ratios.pop(key)
+            self.ratios[key] = similarity
+            return similarity
+        matcher = difflib.SequenceMatcher(None, other.lower(), name.lower())
+        similarity = 0.0
+        if matcher.real_quick_ratio() >= self.threshold and matcher.quick_ratio() >= self.threshold:
+            similarity = matcher.ratio()
+            if similarity < self.threshold:
+                similarity = 0.0
+        return self.remember(self.ratios, key, similarity)
+
+
+def pair_names(candidate_names, known_names, near_misses):
+    """Pair each candidate name with the same known name or, failing that, the nearest miss left, one to one.
+
+    near_misses(name, unpaired_known_names) returns {known name: similarity} for name.  Returns (candidate name,
+    known name, similarity) for each pair, and the candidate names left unpaired.
+    """
+    pairs = []
+    unpaired = []
+    for name in candidate_names:
+        if name in known_names:
+            pairs.append((name, name, 1.0))
+        else:
+            unpaired.append(name)
+    if not unpaired:
+        return pairs, unpaired
+
+    paired_known_names = set(name for name, known_name, similarity in pairs)
+    unpaired_known_names = [known_name for known_name in known_names if known_name not in paired_known_names]
+    if not unpaired_known_names:
+        return pairs, unpaired
+    near_pairs = []
+    for name in unpaired:
+        for known_name, similarity in near_misses(name, unpaired_known_names).items():
+            if similarity and known_name in known_names and known_name not in paired_known_names:
+                near_pairs.append((-similarity, name, known_name))
+    # The nearest misses are paired first
+    near_pairs.sort()
+    unpaired = set(unpaired)
+    for negative_similarity, name, known_name in near_pairs:
+        if name in unpaired and known_name not in paired_known_names:
+            pairs.append((name, known_name, -negative_similarity))
+            unpaired.discard(name)
+            paired_known_names.add(known_name)
+    return pairs, sorted(unpaired)
+
+
+def compare_dbs_fuzzy(candidate, known, name_similarity):
+    """Score candidate against known as compare_dbs does, but with near misses counted.
+
+    Tables and columns are paired with ones of the same name or, failing that, ones name_similarity finds nearly
+    the same (such as urls and url), and a pair with similarity s adds s of the weight to the candidate score and
+    the rest to the known score.  Column types match if SQLite gives them the same affinity, so INT and INTEGER,
+    or VARCHAR(255) and TEXT, are the same.  Identical names and types score just as compare_dbs scores them.
+    """
+    candidate_score = 0.0
+    known_score = 0.0
+
+    table_pairs, unpaired_tables = pair_names(candidate.structure, known.structure, name_similarity.near_misses)
+    for candidate_table, known_table, table_similarity in table_pairs:
+        candidate_score += TABLE_WEIGHT * table_similarity
+        known_score += TABLE_WEIGHT * (1 - table_similarity)
+        candidate_columns = candidate.structure[candidate_table]
+        known_columns = known.structure[known_table]
+        column_pairs, unpaired_columns = pair_names(
+            candidate_columns, known_columns,
+            lambda column, unpaired_known_columns: dict((known_column, name_similarity.ratio(column, known_column))
+                                                        for known_column in unpaired_known_columns))
+        for candidate_column, known_column, column_similarity in column_pairs:
+            candidate_score += COLUMN_WEIGHT * column_similarity
+            known_score += COLUMN_WEIGHT * (1 - column_similarity)
+            candidate_attributes = candidate_columns[candidate_column]
+            known_attributes = known_columns[known_column]
+            for attribute in ATTRIBUTES:
+                if attribute == 'type':
+                    matched = type_affinity(candidate_attributes['type']) == type_affinity(known_attributes['type'])
+                else:
+                    matched = candidate_attributes[attribute] == known_attributes[attribute]
+                if matched:
+                    candidate_score += ATTRIBUTE_WEIGHT
+                known_score += ATTRIBUTE_WEIGHT
+        known_score += COLUMN_WEIGHT * len(unpaired_columns)
+
+    for candidate_table in unpaired_tables:
+        known_score += TABLE_WEIGHT + COLUMN_WEIGHT * len(candidate.structure[candidate_table])
+
+    for known_table in known.structure:
+        known_score += TABLE_WEIGHT + COLUMN_WEIGHT * len(known.structure[known_table])
+
+    return candidate_score, known_score, "{:.1f}".format(100 * candidate_score / known_score)
+
+
+class Catalog(object):
+    """The known_databases table, loaded and parsed into squids once and shared between comparisons.
+
+    The catalog file is stat'ed on refresh() and reloaded if it has changed, so databases added with --learn are
+    picked up without restarting a long-running process.
+
+    table_index, column_index and attribute_index map each table name, (table, column) pair and (table, column,
+    attribute, value) to the positions in entries of the catalog databases that contain them.  known_totals holds
+    the points each entry adds to the known score for its own tables and columns, and table_counts and
+    column_counts how many of each it has.
+
+    Entries are in rowid order; versions[i] is a hash of the ids and structures of the entries up to and including
+    position i, so rankings worked out against an earlier copy of the catalog can tell if they still hold.
+    structure_hashes maps the structure_hash of each entry's structure to the positions of the entries with it.
+
+    The catalog is loaded from its compiled copy (see write_compiled_catalog) when that is up to date, and parsed
+    from SQLite and recompiled when it isn't, or when use_compiled is False.
+
+    With use_prefilter((bands, rows)), candidates_for only returns the entries a MinHashIndex finds similar.  With
+    use_fuzzy(True), entries are scored with compare_dbs_fuzzy, and candidates_for also returns the entries with
+    tables whose names are near misses.
+    """
+    def __init__(self, path, use_compiled=True):
+        self.path = path
+        self.use_compiled = use_compiled
+        self.prefilter = None
+        self.minhash_index = None
+        self.fuzzy = False
+        self.name_similarity = None
+        self.signature = None
+        self.entries = []
+        self.positions = {}
+        self.versions = []
+        self.structure_hashes = {}
+        self.table_index = {}
+        self.column_index = {}
+        self.attribute_index = {}
+        self.known_totals = []
+        self.table_counts = []
+        self.column_counts = []
+        self.load()
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def file_signature(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return stat.st_mtime, stat.st_size
+
+    def load(self):
+        self.signature = self.file_signature()
+        self.minhash_index = None
+        self.name_similarity = None
+
+        # Use the compiled copy of the catalog if it's up to date; otherwise parse the catalog and recompile it
+        if self.use_compiled:
+            try:
+                compiled_catalog = CompiledCatalog(compiled_catalog_path(self.path), self.signature)
+            except (IOError, OSError, ValueError, struct.error):
+                compiled_catalog = None
+            if compiled_catalog:
+                self.load_compiled(compiled_catalog)
+                return
+
+        self.load_sqlite()
+        if self.signature:
+            try:
+                write_compiled_catalog(self)
+            except (IOError, OSError):
+                pass
+
+    def load_sqlite(self):
+        entries = []
+        versions = []
+        version = hashlib.md5()
+        squid_db = sqlite3.connect(self.path)
+        with squid_db:
+            squid_db.row_factory = dict_factory
+            cursor = squid_db.cursor()
+            cursor.execute("SELECT db_name, structure, rowid AS squid_id, program_family, program_name, "
+                           "program_version FROM known_databases ORDER BY rowid")
+            for known_db in cursor:
+                version.update('{}:{}\n'.format(known_db['squid_id'], known_db['structure'].encode('utf-8')))
+                versions.append(version.hexdigest())
+                # Convert 'structure' from string to JSON
+                known_db['structure'] = json.loads(known_db['structure'])
+                # Create a squid from the database row
+                entries.append(squid(**known_db))
+        squid_db.close()
+        self.entries = entries
+        self.versions = versions
+        self.positions = dict((known_squid.squid_id, position) for position, known_squid in enumerate(entries))
+        self.structure_hashes = {}
+        for position, known_squid in enumerate(entries):
+            self.structure_hashes.setdefault(structure_hash(known_squid.structure), []).append(position)
+        self.build_index()
+
+    def load_compiled(self, compiled_catalog):
+        self.entries = compiled_catalog.entries()
+        self.versions = compiled_catalog.versions
+        self.positions = dict((known_squid.squid_id, position) for position, known_squid in enumerate(self.entries))
+        self.structure_hashes = {}
+        for position, entry_hash in enumerate(compiled_catalog.structure_hashes):
+            self.structure_hashes.setdefault(entry_hash, []).append(position)
+        self.table_index, self.column_index, self.attribute_index = compiled_catalog.indexes()
+        self.known_totals = compiled_catalog.known_totals
+        self.table_counts = compiled_catalog.table_counts
+        self.column_counts = compiled_catalog.column_counts
+
+    def build_index(self):
+        self.table_index = {}
+        self.column_index = {}
+        self.attribute_index = {}
+        self.known_totals = []
+        self.table_counts = []
+        self.column_counts = []
+        for position, known_squid in enumerate(self.entries):
+            known_total = 0
+            for table, columns in known_squid.structure.items():
+                self.table_index.setdefault(table, []).append(position)
+                known_total += TABLE_WEIGHT
+                for column, column_attributes in columns.items():
+                    self.column_index.setdefault((table, column), []).append(position)
+                    known_total += COLUMN_WEIGHT
+                    for attribute in ATTRIBUTES:
+                        feature = (table, column, attribute, column_attributes.get(attribute))
+                        self.attribute_index.setdefault(feature, []).append(position)
+            self.known_totals.append(known_total)
+            self.table_counts.append(len(known_squid.structure))
+            self.column_counts.append(sum(len(columns) for columns in known_squid.structure.values()))
+
+    def candidates_for(self, structure):
+        """Return the positions, in catalog order, of entries that share at least one table name with structure.
+
+        Any entry not returned has no tables in common with structure, so compare_dbs would score it 0.  With fuzzy
+        scoring on, entries with tables whose names are near misses are returned too.  With the prefilter on,
+        entries the MinHashIndex doesn't find similar to structure aren't returned.
+        """
+        positions = set()
+        for table in structure:
+            positions.update(self.table_index.get(table, ()))
+            if self.fuzzy:
+                for near_miss in self.fuzzy_names().similar(table):
+                    positions.update(self.table_index[near_miss])
+        if self.prefilter:
+            if self.minhash_index is None:
+                self.minhash_index = MinHashIndex(self, *self.prefilter)
+            positions &= self.minhash_index.similar(structure)
+        return sorted(positions)
+
+    def use_fuzzy(self, fuzzy):
+        """Turn fuzzy scoring on or off, working out the near misses among the catalog's table names if it's on."""
+        self.fuzzy = fuzzy
+        if fuzzy:
+            self.fuzzy_names()
+
+    def fuzzy_names(self):
+        """Return the NameSimilarity for the catalog's table names, building it the first time after each load."""
+        if self.name_similarity is None:
+            self.name_similarity = NameSimilarity(self.table_index)
+        return self.name_similarity
+
+    def use_prefilter(self, prefilter):
+        """Turn the MinHash/LSH prefilter on with a (bands, rows) tuple, or off with None."""
+        if prefilter != self.prefilter:
+            self.prefilter = prefilter
+            self.minhash_index = None
+
+    def refresh(self):
+        if self.file_signature() != self.signature:
+            self.load()
+        return self
+
+
+# The compiled catalog starts with this header: a magic string, the format version, the byte order and scoring
+# weights it was written with, the mtime and size of the catalog it was compiled from, and then the offset and
+# length of each of the sections below.  Every section but string_data is an array of native-endian 32-bit ints.
+COMPILED_CATALOG_MAGIC = 'SQUIDCAT'
+COMPILED_CATALOG_VERSION = 2
+COMPILED_CATALOG_SECTIONS = ['string_offsets', 'string_data', 'values', 'entries', 'tables', 'columns', 'postings',
+                             'table_features', 'column_features', 'attribute_features']
+COMPILED_CATALOG_HEADER = struct.Struct('<8sI8s3Idq' + 'qq' * len(COMPILED_CATALOG_SECTIONS))
+# Number of ints per record in the sections made up of fixed-size records
+COMPILED_ENTRY_FIELDS = 11        # squid_id, db_name, program_family, program_name, program_version,
+                                  # structure_hash, version, first_table, table_count, known_total, column_count
+COMPILED_TABLE_FIELDS = 3         # name, first_column, column_count
+COMPILED_COLUMN_FIELDS = 2 + len(ATTRIBUTES)                # name, table, then a value for each attribute
+COMPILED_FEATURE_FIELDS = {'table_features': 3,             # name, first_posting, posting_count
+                           'column_features': 4,            # table, column, first_posting, posting_count
+                           'attribute_features': 6}         # table, column, attribute, value, first_posting,
+                                                            # posting_count
+# The feature sections are sorted by their ids (all but the last two fields), so they can be searched in place
+
+
+def compiled_catalog_path(catalog_path):
+    return os.path.splitext(catalog_path)[0] + '.squidc'
+
+
+def int_array(values=()):
+    return array.array('i', values)
+
+
+def write_compiled_catalog(known_catalog):
+    """Write a compiled copy of a catalog that was loaded from SQLite, next to it.
+
+    Names and other strings are interned into a string table, and attribute values (as JSON) into a value table;
+    everything else refers to them by index (-1 for None).  Structures are stored as arrays of table and column
+    records, along with each entry's precomputed score totals and the postings lists of the catalog's indexes,
+    sorted by feature.
+    """
+    strings = []
+    string_ids = {}
+    values = []
+    value_ids = {}
+
+    def intern(string):
+        if string is None:
+            return -1
+        if string not in string_ids:
+            string_ids[string] = len(strings)
+            strings.append(string)
+        return string_ids[string]
+
+    def intern_value(value):
+        value_json = json.dumps(value)
+        if value_json not in value_ids:
+            value_ids[value_json] = len(values)
+            values.append(intern(value_json))
+        return value_ids[value_json]
+
+    sections = dict((name, int_array()) for name in COMPILED_CATALOG_SECTIONS)
+    entry_hashes = dict((position, entry_hash) for entry_hash, positions in known_catalog.structure_hashes.items()
+                        for position in positions)
+    for position, known_squid in enumerate(known_catalog.entries):
+        sections['entries'].extend([known_squid.squid_id, intern(known_squid.db_name),
+                                    intern(known_squid.program_family), intern(known_squid.program_name),
+                                    intern(known_squid.program_version), intern(entry_hashes[position]),
+                                    intern(known_catalog.versions[position]),
+                                    len(sections['tables']) // COMPILED_TABLE_FIELDS,
+                                    known_catalog.table_counts[position], known_catalog.known_totals[position],
+                                    known_catalog.column_counts[position]])
+        for table, columns in known_squid.structure.items():
+            sections['tables'].extend([intern(table), len(sections['columns']) // COMPILED_COLUMN_FIELDS,
+                                       len(columns)])
+            for column, column_attributes in columns.items():
+                sections['columns'].extend([intern(column), intern(table)] +
+                                           [intern_value(column_attributes.get(attribute))
+                                            for attribute in ATTRIBUTES])
+
+    def add_postings(positions):
+        sections['postings'].extend(positions)
+        return [len(sections['postings']) - len(positions), len(positions)]
+
+    features = {'table_features': [([intern(table)], positions)
+                                   for table, positions in known_catalog.table_index.items()],
+                'column_features': [([intern(table), intern(column)], positions)
+                                    for (table, column), positions in known_catalog.column_index.items()],
+                'attribute_features': [([intern(table), intern(column), ATTRIBUTES.index(attribute),
+                                         intern_value(value)], positions)
+                                       for (table, column, attribute, value), positions
+                                       in known_catalog.attribute_index.items()]}
+    for name, records in features.items():
+        for key_ids, positions in sorted(records):
+            sections[name].extend(key_ids + add_postings(positions))
+
+    # Interning the attribute values added their JSON to the string table, so build that last
+    sections['values'] = int_array(values)
+    encoded_strings = [string.encode('utf-8') if isinstance(string, unicode) else string for string in strings]
+    sections['string_data'] = ''.join(encoded_strings)
+    string_offsets = [0]
+    for encoded_string in encoded_strings:
+        string_offsets.append(string_offsets[-1] + len(encoded_string))
+    sections['string_offsets'] = int_array(string_offsets)
+
+    section_data = [sections[name] if isinstance(sections[name], str) else sections[name].tostring()
+                    for name in COMPILED_CATALOG_SECTIONS]
+    section_positions = []
+    offset = COMPILED_CATALOG_HEADER.size
+    for data in section_data:
+        section_positions += [offset, len(data)]
+        offset += len(data)
+
+    # Write to a temporary file and move it into place, so a reader never sees a partial file
+    path = compiled_catalog_path(known_catalog.path)
+    temporary_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(temporary_path, 'wb') as compiled_file:
+        compiled_file.write(COMPILED_CATALOG_HEADER.pack(
+            COMPILED_CATALOG_MAGIC, COMPILED_CATALOG_VERSION, sys.byteorder, TABLE_WEIGHT, COLUMN_WEIGHT,
+            ATTRIBUTE_WEIGHT, known_catalog.signature[0], known_catalog.signature[1], *section_positions))
+        for data in section_data:
+            compiled_file.write(data)
+    if os.name == 'nt' and os.path.exists(path):
+        os.remove(path)
+    os.rename(temporary_path, path)
+
+
+class CompiledCatalog(object):
+    """Reads a catalog compiled by write_compiled_catalog, through a read-only memory map of the file.
+
+    Raises ValueError if the file isn't a compiled catalog, or wasn't compiled from a catalog with the given
+    signature using the current format, byte order and scoring weights.  Entry structures aren't built until they
+    are used, and are read straight from the mapped file, so processes sharing a compiled catalog share the pages
+    holding its structures.
+    """
+    def __init__(self, path, signature):
+        with open(path, 'rb') as compiled_file:
+            self.mapping = mmap.mmap(compiled_file.fileno(), 0, access=mmap.ACCESS_READ)
+        header = COMPILED_CATALOG_HEADER.unpack_from(self.mapping, 0)
+        if header[:6] != (COMPILED_CATALOG_MAGIC, COMPILED_CATALOG_VERSION, sys.byteorder.ljust(8, '\x00'),
+                          TABLE_WEIGHT, COLUMN_WEIGHT, ATTRIBUTE_WEIGHT) or signature is None or \
+                header[6:8] != signature:
+            raise ValueError('{} is out of date or not a compiled catalog'.format(path))
+        self.sections = dict(zip(COMPILED_CATALOG_SECTIONS, zip(header[8::2], header[9::2])))
+
+        string_offsets = self.section_array('string_offsets')
+        string_data = self.section_bytes('string_data')
+        self.strings = [string_data[string_offsets[index]:string_offsets[index + 1]].decode('utf-8')
+                        for index in range(len(string_offsets) - 1)]
+        self.values = [json.loads(self.strings[value]) for value in self.section_array('values')]
+        self.string_ids = None
+        self.value_ids = None
+
+        self.entry_records = self.section_array('entries')
+        entry_fields = [self.entry_records[field::COMPILED_ENTRY_FIELDS] for field in range(COMPILED_ENTRY_FIELDS)]
+        self.structure_hashes = [self.strings[string] for string in entry_fields[5]]
+        self.versions = [self.strings[string] for string in entry_fields[6]]
+        self.known_totals = entry_fields[9].tolist()
+        self.table_counts = entry_fields[8].tolist()
+        self.column_counts = entry_fields[10].tolist()
+
+    def section_bytes(self, name):
+        offset, length = self.sections[name]
+        return self.mapping[offset:offset + length]
+
+    def section_array(self, name):
+        section = int_array()
+        section.fromstring(self.section_bytes(name))
+        return section
+
+    def string(self, string_id):
+        return None if string_id < 0 else self.strings[string_id]
+
+    def entries(self):
+        entries = []
+        for position in range(len(self.entry_records) // COMPILED_ENTRY_FIELDS):
+            record = self.entry_records[position * COMPILED_ENTRY_FIELDS:(position + 1) * COMPILED_ENTRY_FIELDS]
+            entries.append(CompiledSquid(self, position, db_name=self.string(record[1]),
+                                         program_family=self.string(record[2]), program_name=self.string(record[3]),
+                                         program_version=self.string(record[4]), squid_id=record[0]))
+        return entries
+
+    def structure(self, position):
+        """Build the structure dict of the entry at position from its table and column records."""
+        first_table, table_count = self.entry_records[position * COMPILED_ENTRY_FIELDS + 7:
+                                                      position * COMPILED_ENTRY_FIELDS + 9]
+        tables_offset = self.sections['tables'][0]
+        columns_offset = self.sections['columns'][0]
+        item_size = int_array().itemsize
+        table_record = struct.Struct('={}i'.format(COMPILED_TABLE_FIELDS))
+        column_record = struct.Struct('={}i'.format(COMPILED_COLUMN_FIELDS))
+
+        structure = {}
+        for table_number in range(first_table, first_table + table_count):
+            table_name, first_column, column_count = table_record.unpack_from(
+                self.mapping, tables_offset + table_number * COMPILED_TABLE_FIELDS * item_size)
+            table = structure[self.strings[table_name]] = {}
+            for column_number in range(first_column, first_column + column_count):
+                column = column_record.unpack_from(
+                    self.mapping, columns_offset + column_number * COMPILED_COLUMN_FIELDS * item_size)
+                table[self.strings[column[0]]] = dict(zip(ATTRIBUTES, [self.values[value] for value in column[2:]]))
+        return structure
+
+    def indexes(self):
+        """Return the catalog's table, column and attribute indexes, which look features up in the mapped file."""
+        return [CompiledIndex(self, name) for name in ['table_features', 'column_features', 'attribute_features']]
+
+    def string_id(self, string):
+        if self.string_ids is None:
+            self.string_ids = dict((string, string_id) for string_id, string in enumerate(self.strings))
+        return self.string_ids.get(string)
+
+    def value_id(self, value):
+        if self.value_ids is None:
+            self.value_ids = {}
+            for value_id, known_value in enumerate(self.values):
+                self.value_ids.setdefault(known_value, value_id)
+        try:
+            return self.value_ids.get(value)
+        except TypeError:
+            return None
+
+
+class CompiledIndex(object):
+    """One of a CompiledCatalog's indexes, mapping features to postings lists like the dicts Catalog builds.
+
+    Building dicts of every feature would take most of the time to load a large catalog, in every process, so
+    features are instead found by a binary search of the sorted records in the mapped file.
+    """
+    def __init__(self, compiled_catalog, name):
+        self.compiled_catalog = compiled_catalog
+        self.name = name
+        self.offset, length = compiled_catalog.sections[name]
+        self.record = struct.Struct('={}i'.format(COMPILED_FEATURE_FIELDS[name]))
+        self.key_fields = COMPILED_FEATURE_FIELDS[name] - 2
+        self.record_count = length // self.record.size
+
+    def __len__(self):
+        return self.record_count
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __getitem__(self, key):
+        positions = self.get(key)
+        if positions is None:
+            raise KeyError(key)
+        return positions
+
+    def __iter__(self):
+        return (self.key(self.record_at(record_number)) for record_number in range(self.record_count))
+
+    def record_at(self, record_number):
+        return self.record.unpack_from(self.compiled_catalog.mapping, self.offset + record_number * self.record.size)
+
+    def postings(self, first_posting, posting_count):
+        offset = self.compiled_catalog.sections['postings'][0] + first_posting * int_array().itemsize
+        positions = int_array()
+        positions.fromstring(self.compiled_catalog.mapping[offset:offset + posting_count * int_array().itemsize])
+        return positions
+
+    def key_ids(self, key):
+        """Return the ids a feature's record starts with, or None if a string or value in it isn't in the catalog."""
+        compiled_catalog = self.compiled_catalog
+        if self.name == 'table_features':
+            key_ids = (compiled_catalog.string_id(key),)
+        elif self.name == 'column_features':
+            key_ids = (compiled_catalog.string_id(key[0]), compiled_catalog.string_id(key[1]))
+        else:
+            key_ids = (compiled_catalog.string_id(key[0]), compiled_catalog.string_id(key[1]),
+                       ATTRIBUTES.index(key[2]), compiled_catalog.value_id(key[3]))
+        return None if None in key_ids else key_ids
+
+    def get(self, key, default=None):
+        key_ids = self.key_ids(key)
+        if key_ids is None:
+            return default
+        low, high = 0, self.record_count
+        while low < high:
+            middle = (low + high) // 2
+            if self.record_at(middle)[:self.key_fields] < key_ids:
+                low = middle + 1
+            else:
+                high = middle
+        if low < self.record_count:
+            record = self.record_at(low)
+            if record[:self.key_fields] == key_ids:
+                return self.postings(*record[-2:])
+        return default
+
+    def key(self, record):
+        """Return the feature a record is for, the reverse of key_ids."""
+        strings = self.compiled_catalog.strings
+        if self.name == 'table_features':
+            return strings[record[0]]
+        elif self.name == 'column_features':
+            return strings[record[0]], strings[record[1]]
+        return strings[record[0]], strings[record[1]], ATTRIBUTES[record[2]], self.compiled_catalog.values[record[3]]
+
+    def items(self):
+        for record_number in range(self.record_count):
+            record = self.record_at(record_number)
+            yield self.key(record), self.postings(*record[-2:])
+
+
+class CompiledSquid(squid):
+    """A catalog entry from a CompiledCatalog, whose structure is only built when it's first used."""
+    def __init__(self, compiled_catalog, position, **kwargs):
+        self.compiled_catalog = compiled_catalog
+        self.position = position
+        squid.__init__(self, structure=None, **kwargs)
+
+    @property
+    def structure(self):
+        if self._structure is None:
+            self._structure = self.compiled_catalog.structure(self.position)
+        return self._structure
+
+    @structure.setter
+    def structure(self, structure):
+        self._structure = structure
+
+
+def compile_catalog(catalog_path):
+    """(Re)compile the catalog at catalog_path from its SQLite contents."""
+    Catalog(catalog_path, use_compiled=False)
+
+
+# Catalogs that have already been loaded in this process, keyed by path
+loaded_catalogs = {}
+
+
+def load_catalog(catalog_path, prefilter=None, fuzzy=False):
+    catalog_path = os.path.realpath(catalog_path)
+    if catalog_path not in loaded_catalogs:
+        loaded_catalogs[catalog_path] = Catalog(catalog_path)
+    if prefilter:
+        loaded_catalogs[catalog_path].use_prefilter(prefilter)
+    known_catalog = loaded_catalogs[catalog_path].refresh()
+    if fuzzy:
+        known_catalog.use_fuzzy(fuzzy)
+    return known_catalog
+
+
+def minhash_token(*names):
+    """Return the 64-bit hash MinHash signatures use for a table name or a (table, column) pair."""
+    token = '\x00'.join(name.encode('utf-8') if isinstance(name, unicode) else name for name in names)
+    return struct.unpack('<Q', hashlib.md5(token).digest()[:8])[0]
+
+
+class MinHashIndex(object):
+    """An LSH index over MinHash signatures of the catalog entries' table names and (table, column) pairs.
+
+    Signatures are one-permutation MinHashes: each token's hash picks one of bands * rows bins and the smallest
+    value in each bin is kept, with empty bins borrowing from the next full one.  A bin matches between two
+    structures with a chance about equal to the Jaccard similarity J of their tokens, so an entry shares a bucket
+    with a structure in at least one band with a chance of 1 - (1 - J^rows)^bands.  More bands, or fewer rows,
+    find more of the similar entries but pass more dissimilar ones on to be scored too.
+
+    The signatures are built from the catalog's table and column indexes, so entries' structures aren't touched.
+    """
+
+    def __init__(self, known_catalog, bands, rows):
+        self.bands = bands
+        self.rows = rows
+        size = bands * rows
+        entry_bins = [[None] * size for _ in range(len(known_catalog))]
+        features = [((table,), positions) for table, positions in known_catalog.table_index.items()] + \
+                   [(table_column, positions) for table_column, positions in known_catalog.column_index.items()]
+        for names, positions in features:
+            token_hash = minhash_token(*names)
+            token_bin, value = token_hash % size, token_hash // size
+            for position in positions:
+                bins = entry_bins[position]
+                if bins[token_bin] is None or value < bins[token_bin]:
+                    bins[token_bin] = value
+
+        self.buckets = [{} for _ in range(bands)]
+        for position, bins in enumerate(entry_bins):
+            for band, key in enumerate(self.band_keys(bins)):
+                self.buckets[band].setdefault(key, []).append(position)
+
+    def band_keys(self, bins):
+        """Fill in the empty bins, then split them into one key per band; a structure with no tokens has none."""
+        size = len(bins)
+        full_bins = [index for index, value in enumerate(bins) if value is not None]
+        if not full_bins:
+            return []
+        signature = list(bins)
+        for index in range(size):
+            if bins[index] is None:
+                # Borrow from the next full bin along, noting how far away it was
+                distance = min((full_bin - index) % size for full_bin in full_bins)
+                signature[index] = (bins[(index + distance) % size], distance)
+        return [tuple(signature[band * self.rows:(band + 1) * self.rows]) for band in range(self.bands)]
+
+    def similar(self, structure):
+        """Return the set of positions of the entries sharing a bucket with structure in any band."""
+        size = self.bands * self.rows
+        bins = [None] * size
+        tokens = [(table,) for table in structure] + \
+                 [(table, column) for table, columns in structure.items() for column in columns]
+        for names in tokens:
+            token_hash = minhash_token(*names)
+            token_bin, value = token_hash % size, token_hash // size
+            if bins[token_bin] is None or value < bins[token_bin]:
+                bins[token_bin] = value
+
+        positions = set()
+        for band, key in enumerate(self.band_keys(bins)):
+            positions.update(self.buckets[band].get(key, ()))
+        return positions
+
+
+def compare_batch(candidates, squid_reference_database):
+    """Score a list of candidate squids against every database in the catalog at once.
+
+    Returns one dict per candidate mapping the position of each catalog entry that shares a table with it to the
+    (candidate_score, known_score, percent) tuple compare_dbs would give; compare_dbs would score every other entry 0.
+
+    Rather than walking both structures for every pair, each candidate is treated as a sparse vector of table,
+    (table, column) and (table, column, attribute, value) features and multiplied against the catalog's indexes, so
+    only the entries sharing a feature are touched.  compare_dbs' known score is the catalog entry's own total, plus
+    the full weight of every candidate table and column, less the weight of the ones that matched (each matched
+    column still adds its attribute weights):
+
+        known_score = known_total + TABLE_WEIGHT * (tables - matched_tables)
+                      + COLUMN_WEIGHT * (columns - matched_columns)
+                      + ATTRIBUTE_WEIGHT * len(ATTRIBUTES) * matched_columns
+    """
+    known_catalog = squid_reference_database
+    if isinstance(known_catalog, Catalog):
+        known_catalog.refresh()
+    else:
+        known_catalog = load_catalog(known_catalog)
+
+    matched_column_adjustment = ATTRIBUTE_WEIGHT * len(ATTRIBUTES) - COLUMN_WEIGHT
+    batch_scores = []
+    for candidate in candidates:
+        # Only the entries the candidate's features touch are kept, so a large catalog costs no more than a small one
+        candidate_scores = collections.defaultdict(int)
+        known_adjustments = collections.defaultdict(int)
+        unmatched_score = 0
+
+        for table, columns in candidate.structure.items():
+            unmatched_score += TABLE_WEIGHT
+            for position in known_catalog.table_index.get(table, ()):
+                candidate_scores[position] += TABLE_WEIGHT
+                known_adjustments[position] -= TABLE_WEIGHT
+            for column, column_attributes in columns.items():
+                unmatched_score += COLUMN_WEIGHT
+                for position in known_catalog.column_index.get((table, column), ()):
+                    candidate_scores[position] += COLUMN_WEIGHT
+                    known_adjustments[position] += matched_column_adjustment
+                for attribute in ATTRIBUTES:
+                    feature = (table, column, attribute, column_attributes[attribute])
+                    for position in known_catalog.attribute_index.get(feature, ()):
+                        candidate_scores[position] += ATTRIBUTE_WEIGHT
+
+        scores = {}
+        for position, candidate_score in candidate_scores.items():
+            known_score = known_catalog.known_totals[position] + unmatched_score + known_adjustments[position]
+            scores[position] = (candidate_score, known_score,
+                                "{:.1f}".format(100 * float(candidate_score) / known_score))
+        batch_scores.append(scores)
+
+    return batch_scores
+
+
 def learn_db(db_name, new_database_path, program_family, program_name, program_version):
     new_database = squid(db_name, path=new_database_path, program_family=program_family, program_name=program_name,
                          program_version=program_version)
     new_database.build_structure()
     new_database.db_name = os.path.split(new_database.db_name)[1]
 
+    # A schema only partly recovered from a damaged file would be learned as if it were the program's whole schema
+    if new_database.partial:
+        print
+        print textwrap.fill("- Not learning {}; it is damaged and its schema could only be partly recovered.\n"
+                            .format(new_database_path), width=75, initial_indent=" ", subsequent_indent="   ")
+        return
+
     if new_database.structure != {}:
         # Connect to SQUID db
         database_path = os.path.join(os.path.dirname(os.path.realpath(sys.argv[0])), 'catalog.sqlite')
@@ -143,13 +1796,7 @@ def learn_db(db_name, new_database_path, program_family, program_name, program_v
         with db:
             db.row_factory = dict_factory
             cursor = db.cursor()
-            cursor.execute("CREATE TABLE IF NOT EXISTS known_databases("
-                           "program_family TEXT,"
-                           "program_name TEXT,"
-                           "program_version TEXT,"
-                           "db_name TEXT,"
-                           "structure TEXT,"
-                           "structure_md5 TEXT)")
+            create_known_databases(cursor)
 
             m = hashlib.md5()
             m.update(json.dumps(new_database.structure))
@@ -171,12 +1818,7 @@ def learn_db(db_name, new_database_path, program_family, program_name, program_v
                     update = raw_input("   Would you like to add this new version number to this existing entry in "
                                        "the\n   SQUID catalog? \n   (Y)es or (N)o? ")
                     if update[0].lower() == 'y':
-                        new_versions = json.loads(matches[0]['program_version'])
-                        new_versions.append(program_version)
-                        try:
-                            new_versions.sort(key=float)
-                        except:
-                            new_versions.sort()
+                        new_versions = sort_versions(json.loads(matches[0]['program_version']) + [program_version])
                         cursor.execute("UPDATE known_databases SET program_version = ? WHERE (structure_md5 = ? "
                                        "AND program_name = ?)", (json.dumps(new_versions), matches[0]['structure_md5'],
                                                                  matches[0]['program_name']))
@@ -212,8 +1854,7 @@ def learn_db(db_name, new_database_path, program_family, program_name, program_v
                     if 0 < int(update[0]) <= len(matches):
                         new_versions = json.loads(matches[int(update[0])-1]['program_version'])
                         if program_version not in new_versions:
-                            new_versions.append(program_version)
-                            new_versions.sort()
+                            new_versions = sort_versions(new_versions + [program_version])
                         cursor.execute("UPDATE known_databases SET program_version = ? WHERE (structure_md5 = ? "
                                        "AND program_name = ?)",
                                        (json.dumps(new_versions), matches[int(update[0])-1]['structure_md5'],
@@ -247,171 +1888,1382 @@ def learn_program(program_path, program_family, program_name, program_version):
         learn_db(potential_db, os.path.join(program_path, potential_db), program_family, program_name, program_version)
 
 
-def compare_to_known(candidate_db, squid_reference_database):
-    top_three_matches = []
-    short_columns = "{:>25}  {:>5}%  {:<25} {:<18}"
+def read_learn_manifest(manifest_path, program_family, program_name, program_version):
+    """Return a dict per DB listed in a CSV or JSON manifest of path, program, version, family (and optional name).
 
-    def print_short_comparison(score, known_db, candidate_db_name):
-        if len(candidate_db_name) > 25:
-            candidate_db_name = candidate_db_name[:23] + ".."
-        if len(known_db.db_name) > 25:
-            known_db.db_name = known_db.db_name[:23] + ".."
-        if len(known_db.program_name) > 22:
-            known_db.program_name = known_db.program_name[:20] + ".."
-        print(short_columns.format(candidate_db_name, score, known_db.db_name, known_db.program_name))
-
-    def add_rank(rankings, score, known_squid):
-        if len(rankings) < 3:
-            rankings.append({'score': score, 'squid': known_squid})
-            rankings = sorted(rankings, key=lambda k: k['score'], reverse=True)
+    A JSON manifest is a list of objects with those keys; a CSV one has them as its header row.  Relative paths are
+    relative to the manifest, and anything missing from a row falls back to the -f, -p and -v values.
+    """
+    with open(manifest_path, 'rb') as manifest_file:
+        if manifest_path.lower().endswith('.json'):
+            rows = json.load(manifest_file)
         else:
-            if rankings[2]['score'] < score:
-                rankings.pop()
-                rankings.append({'score': score, 'squid': known_squid})
-                rankings = sorted(rankings, key=lambda k: k['score'], reverse=True)
-
-        return rankings
-
-    # Connect to SQUID db
-    squid_db = sqlite3.connect(squid_reference_database)
-    with squid_db:
-        squid_db.row_factory = dict_factory
-        cursor = squid_db.cursor()
-        cursor.execute("SELECT db_name, structure, rowid AS squid_id, program_family, program_name, program_version "
-                       "FROM known_databases")
-        for known_db in cursor:
-            # Convert 'structure' from string to JSON
-            known_db['structure'] = json.loads(known_db['structure'])
-            # Create a squid from the database row
-            known_squid = squid(**known_db)
-            score = compare_dbs(candidate_db, known_squid)
-            top_three_matches = add_rank(top_three_matches, float(score[2]), known_squid)
+            rows = list(csv.DictReader(manifest_file))
+
+    manifest_directory = os.path.dirname(os.path.abspath(manifest_path))
+    entries = []
+    for row in rows:
+        path = os.path.join(manifest_directory, row['path'])
+        entries.append({'path': path, 'name': row.get('name') or os.path.basename(path),
+                        'family': row.get('family') or program_family,
+                        'program': row.get('program') or program_name,
+                        'version': row.get('version') or program_version})
+    return entries
+
+
+def learn_structure_worker(path):
+    """Return the structure of the file at path and its MD5, or None and why it can't be learned."""
+    new_database = squid(path=path)
+    new_database.build_structure()
+    # Partly recovered schemas aren't learned
+    if new_database.rejected or new_database.partial or new_database.structure == {}:
+        return None, new_database.rejected or ('damaged' if new_database.partial else 'no tables')
+    # Hashed here, as learn_db does, since the dicts don't keep their order on the way back from a worker
+    m = hashlib.md5()
+    m.update(json.dumps(new_database.structure))
+    return new_database.structure, m.hexdigest()
+
+
+def learn_batch(source, catalog_path, program_family, program_name, program_version, duplicates='merge', jobs=1):
+    """Learn every DB in a manifest or directory tree without prompting, in a single catalog transaction.
+
+    A structure already in the catalog (or earlier in the batch) is handled by the duplicates policy: 'merge' adds
+    the version to the existing entry for the same program, 'new' always adds another entry, and 'skip' leaves the
+    catalog alone.  Returns a Counter of what happened to the DBs: learned, merged, skipped or already known, or
+    why they couldn't be learned (the header check's reasons, damaged for DBs whose schema could only be partly
+    recovered, or no tables).
+    """
+    if os.path.isdir(source):
+        entries = [{'path': path, 'name': os.path.basename(path), 'family': program_family,
+                    'program': program_name, 'version': program_version} for path in walk_files(source)]
+    else:
+        entries = read_learn_manifest(source, program_family, program_name, program_version)
+
+    paths = [entry['path'] for entry in entries]
+    if jobs > 1:
+        pool = multiprocessing.Pool(jobs)
+        structures = pool.imap(learn_structure_worker, paths, chunksize=16)
+    else:
+        pool = None
+        structures = (learn_structure_worker(path) for path in paths)
+
+    outcomes = collections.Counter()
+    db = sqlite3.connect(catalog_path)
+    try:
+        with db:
+            cursor = db.cursor()
+            create_known_databases(cursor)
+            known = known_structures(cursor)
+
+            for entry, (structure, structure_md5) in zip(entries, structures):
+                if structure is None:
+                    # Why it couldn't be learned, such as unreadable (a typo in a manifest) or not SQLite
+                    outcomes[structure_md5] += 1
+                    continue
+                existing = known.get(structure_hash(structure))
+
+                if existing and (duplicates == 'skip' or duplicates == 'merge' and entry['program'] in existing):
+                    if duplicates == 'skip':
+                        outcomes['skipped'] += 1
+                        continue
+                    rowid, existing_versions = existing[entry['program']]
+                    versions = json.loads(existing_versions)
+                    if entry['version'] in versions:
+                        outcomes['already known'] += 1
+                        continue
+                    versions = sort_versions(versions + [entry['version']])
+                    cursor.execute("UPDATE known_databases SET program_version = ? WHERE rowid = ?",
+                                   (json.dumps(versions), rowid))
+                    existing[entry['program']] = (rowid, json.dumps(versions))
+                    outcomes['merged'] += 1
+                else:
+                    version_list = json.dumps([entry['version']])
+                    cursor.execute("INSERT INTO known_databases (program_family, program_name, program_version, "
+                                   "db_name, structure, structure_md5) VALUES (?, ?, ?, ?, ?, ?)",
+                                   (entry['family'], entry['program'], version_list, entry['name'],
+                                    json.dumps(structure), structure_md5))
+                    known[structure_hash(structure)].setdefault(entry['program'],
+                                                                (cursor.lastrowid, version_list))
+                    outcomes['learned'] += 1
+    finally:
+        db.close()
+        if pool:
+            pool.terminate()
+    return outcomes
+
+
+def create_known_databases(cursor):
+    cursor.execute("CREATE TABLE IF NOT EXISTS known_databases("
+                   "program_family TEXT,"
+                   "program_name TEXT,"
+                   "program_version TEXT,"
+                   "db_name TEXT,"
+                   "structure TEXT,"
+                   "structure_md5 TEXT)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS known_databases_structure_md5 ON known_databases (structure_md5)")
+
+
+def known_structures(cursor):
+    """Return {structure hash: {program name: (rowid, program_version JSON)}} for the catalog's entries.
+
+    Everything learned is found by structure without a query per DB.  The hashes are structure_hash()es of the
+    parsed structures rather than the stored MD5s, which depend on the order json.dumps happened to write the keys
+    in, so equal structures are found however they were learned.  Where a program has the same structure more than
+    once, the first entry is used.
+    """
+    known = collections.defaultdict(dict)
+    for rowid, structure, known_program, known_versions in cursor.execute(
+            "SELECT rowid, structure, program_name, program_version FROM known_databases ORDER BY rowid"):
+        known[structure_hash(json.loads(structure))].setdefault(known_program, (rowid, known_versions))
+    return known
+
+
+def sort_versions(versions):
+    """Return versions sorted numerically if they're all numbers, and as strings otherwise."""
+    try:
+        return sorted(versions, key=float)
+    except (TypeError, ValueError):
+        return sorted(versions)
+
+
+def merge_catalog(other_path, catalog_path):
+    """Merge the entries of the catalog at other_path into the one at catalog_path, in a single transaction.
+
+    The catalogs are matched up by structure hash (see known_structures) and program name in one pass over each.
+    An entry already here with all of the other entry's versions is left alone; otherwise the first entry here
+    for the structure and program gets the versions it's missing, sorted by sort_versions.  Entries with no
+    match are added, after those already in the catalog.  Returns a Counter of what happened to the other
+    catalog's entries, along with how many entries are only in this catalog.
+    """
+    other_db = sqlite3.connect(other_path)
+    try:
+        other_entries = other_db.execute("SELECT program_family, program_name, program_version, db_name, structure "
+                                         "FROM known_databases ORDER BY rowid").fetchall()
+    finally:
+        other_db.close()
+
+    outcomes = collections.Counter()
+    db = sqlite3.connect(catalog_path)
+    try:
+        with db:
+            cursor = db.cursor()
+            create_known_databases(cursor)
+            known = collections.defaultdict(list)
+            for rowid, structure, program_name, program_version in cursor.execute(
+                    "SELECT rowid, structure, program_name, program_version FROM known_databases ORDER BY rowid"):
+                versions = json.loads(program_version)
+                known[(structure_hash(json.loads(structure)), program_name)].append(
+                    [rowid, versions if isinstance(versions, list) else [versions]])
+            unmatched = set(known)
+
+            updates = {}
+            additions = collections.OrderedDict()
+            for program_family, program_name, program_version, db_name, structure in other_entries:
+                entry_hash = structure_hash(json.loads(structure))
+                versions = json.loads(program_version)
+                if not isinstance(versions, list):
+                    versions = [versions]
+                unmatched.discard((entry_hash, program_name))
+
+                if (entry_hash, program_name) in additions:
+                    # The other catalog has this structure for the program more than once
+                    added_versions = additions[(entry_hash, program_name)][2]
+                    added_versions.extend(version for version in versions if version not in added_versions)
+                    outcomes['merged'] += 1
+                elif (entry_hash, program_name) in known:
+                    known_entries = known[(entry_hash, program_name)]
+                    if any(set(versions) <= set(known_versions) for rowid, known_versions in known_entries):
+                        outcomes['already known'] += 1
+                        continue
+                    rowid, known_versions = known_entries[0]
+                    known_entries[0][1] = updates[rowid] = sort_versions(
+                        known_versions + [version for version in versions if version not in known_versions])
+                    outcomes['merged'] += 1
+                else:
+                    additions[(entry_hash, program_name)] = [program_family, program_name, versions, db_name, structure]
+                    outcomes['added'] += 1
+
+            cursor.executemany("UPDATE known_databases SET program_version = ? WHERE rowid = ?",
+                               [(json.dumps(versions), rowid) for rowid, versions in updates.items()])
+            # Stored MD5s are of the structure's JSON as stored, the same as learn_db's
+            cursor.executemany("INSERT INTO known_databases (program_family, program_name, program_version, db_name, "
+                               "structure, structure_md5) VALUES (?, ?, ?, ?, ?, ?)",
+                               [(program_family, program_name, json.dumps(sort_versions(versions)), db_name,
+                                 structure, hashlib.md5(structure.encode('utf-8')).hexdigest())
+                                for program_family, program_name, versions, db_name, structure in additions.values()])
+            outcomes['only in this catalog'] = len(unmatched)
+    finally:
+        db.close()
+    return outcomes
+
+
+def print_short_comparison(score, known_db, candidate_db_name):
+    short_columns = "{:>25}  {:>5}%  {:<25} {:<18}"
+    # Truncate copies of the names; known_db is shared with every other comparison against the catalog
+    known_db_name = known_db.db_name
+    known_program_name = known_db.program_name
+    if len(candidate_db_name) > 25:
+        candidate_db_name = candidate_db_name[:23] + ".."
+    if len(known_db_name) > 25:
+        known_db_name = known_db_name[:23] + ".."
+    if len(known_program_name) > 22:
+        known_program_name = known_program_name[:20] + ".."
+    print(short_columns.format(candidate_db_name, score, known_db_name, known_program_name))
+
+
+def max_match_score(candidate_tables, candidate_columns, known_total, known_tables, known_columns):
+    """Return the highest match percentage a candidate could get against a catalog entry, from counts alone.
+
+    At best every table and column in the smaller of the two structures matches, along with all their attributes.
+    That maximizes compare_dbs' candidate score and, as matched tables and columns add less to it than unmatched
+    ones do, minimizes its known score.
+    """
+    matched_tables = min(candidate_tables, known_tables)
+    matched_columns = min(candidate_columns, known_columns)
+    attributes_weight = ATTRIBUTE_WEIGHT * len(ATTRIBUTES)
+    candidate_score = TABLE_WEIGHT * matched_tables + (COLUMN_WEIGHT + attributes_weight) * matched_columns
+    known_score = known_total + TABLE_WEIGHT * (candidate_tables - matched_tables) + \
+        COLUMN_WEIGHT * candidate_columns - max(COLUMN_WEIGHT - attributes_weight, 0) * matched_columns
+    return 100 * float(candidate_score) / known_score
+
+
+def compare_to_known(candidate_db, squid_reference_database, scores=None, verbose=True, previous_matches=None,
+                     first_position=0, top=3, identical_positions=()):
+    """Rank the catalog entries most like candidate_db, returning the top matches as a list of score/squid dicts.
+
+    Ties go to the entry earliest in the catalog.  previous_matches are the rankings against the catalog entries
+    before first_position, if they're known already.  The entries at identical_positions have the same structure
+    as candidate_db, so they're ranked at 100% without being scored.
+    """
+    # Use the shared, pre-parsed catalog rather than re-reading it for every candidate
+    known_catalog = squid_reference_database
+    if isinstance(known_catalog, Catalog):
+        known_catalog.refresh()
+    else:
+        known_catalog = load_catalog(known_catalog)
+
+    # Keep the best matches in a min-heap of (score, -position, squid), so the worst of them is always at rankings[0]
+    rankings = []
+
+    def add_rank(score, position):
+        ranking = (score, -position, known_catalog.entries[position])
+        if len(rankings) < top:
+            heapq.heappush(rankings, ranking)
+        elif ranking[:2] > rankings[0][:2]:
+            heapq.heapreplace(rankings, ranking)
+
+    for match in previous_matches or []:
+        add_rank(match['score'], known_catalog.positions[match['squid'].squid_id])
+    identical_positions = set(position for position in identical_positions if position >= first_position)
+    for position in identical_positions:
+        add_rank(100.0, position)
+
+    # Only score the catalog entries that share a table with the candidate; the rest would all score 0.  If the
+    # scores were already worked out by compare_batch, just rank them.
+    scored_positions = [position for position in known_catalog.candidates_for(candidate_db.structure)
+                        if position >= first_position and position not in identical_positions]
+    if scores is not None:
+        for position in scored_positions:
+            add_rank(float(scores[position][2]), position)
+    else:
+        # Work through the entries from the highest possible score down, and stop once the best any of the rest
+        # could do wouldn't make the rankings
+        candidate_tables = len(candidate_db.structure)
+        candidate_columns = sum(len(columns) for columns in candidate_db.structure.values())
+        bounded_positions = []
+        for position in scored_positions:
+            max_score = max_match_score(candidate_tables, candidate_columns, known_catalog.known_totals[position],
+                                        known_catalog.table_counts[position], known_catalog.column_counts[position])
+            bounded_positions.append((float("{:.1f}".format(max_score)), position))
+        bounded_positions.sort(key=lambda bounded_position: (-bounded_position[0], bounded_position[1]))
+        for max_score, position in bounded_positions:
+            if len(rankings) >= top and max_score < rankings[0][0]:
+                break
+            if known_catalog.fuzzy:
+                score = compare_dbs_fuzzy(candidate_db, known_catalog.entries[position], known_catalog.fuzzy_names())
+            else:
+                score = compare_dbs(candidate_db, known_catalog.entries[position])
+            add_rank(float(score[2]), position)
+
+    # If there weren't enough of those to fill the rankings, pad them with 0% entries in catalog order, the same as
+    # scoring the whole catalog would have
+    if len(rankings) < top:
+        scored_positions = set(scored_positions) | identical_positions
+        for position in range(first_position, len(known_catalog)):
+            if len(rankings) >= top:
+                break
+            if position not in scored_positions:
+                add_rank(0.0, position)
+
+    top_matches = [{'score': score, 'squid': known_squid}
+                   for score, negative_position, known_squid in sorted(rankings, reverse=True)]
 
     # If the match is over 90%, just print
-    if top_three_matches[0]['score'] > 90:
-        print_short_comparison(top_three_matches[0]['score'], top_three_matches[0]['squid'], candidate_db.db_name)
+    if verbose and top_matches[0]['score'] > 90:
+        print_short_comparison(top_matches[0]['score'], top_matches[0]['squid'], candidate_db.db_name)
+
+    return top_matches
+
 
-    return top_three_matches
+def structure_hash(structure):
+    """MD5 of a structure's JSON with the keys sorted, so equal structures always hash the same."""
+    return hashlib.md5(json.dumps(structure, sort_keys=True)).hexdigest()
 
 
-def compare_each(known_db, dirname, names):
-    for file_name in names:
-        file_path = os.path.join(dirname, file_name)
-        candidate = squid(db_name=file_name, path=file_path)
-        candidate.build_structure()
-        if candidate.structure != {}:
-            top_three = compare_to_known(candidate, known_db)
-            results.append({'file_name': file_name, 'file_path': file_path, 'top_three': top_three})
+def file_identity(path):
+    """Return (size, mtime, inode) for the file at path, or None if it can't be stat'ed."""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_size, stat.st_mtime, stat.st_ino
 
 
-def write_xlsx(output):
-    def friendly_version(version_json):
-        version_list = json.loads(version_json)
-        if isinstance(version_list, list):
-            if len(version_list) > 1:
-                return str(version_list[0]) + " - " + str(version_list[-1])
+class ScanCache(object):
+    """Structures and match rankings from earlier scans, kept in a SQLite file between runs.
+
+    A file's structure is reused as long as its size, mtime and inode haven't changed.  Rankings are kept per
+    structure hash along with how much of the catalog they cover (a count of entries and the catalog's version at
+    that point), so after --learn adds to the catalog only the new entries need scoring.
+    """
+    # Caches written with a different version of the tables below are discarded
+    SCHEMA_VERSION = 2
+
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path, timeout=60)
+        self.db.execute("PRAGMA journal_mode = WAL")
+        if self.db.execute("PRAGMA user_version").fetchone()[0] != self.SCHEMA_VERSION:
+            with self.db:
+                self.db.execute("DROP TABLE IF EXISTS files")
+                self.db.execute("DROP TABLE IF EXISTS matches")
+            self.db.execute("PRAGMA user_version = {}".format(self.SCHEMA_VERSION))
+        with self.db:
+            self.db.execute("CREATE TABLE IF NOT EXISTS files("
+                            "path TEXT PRIMARY KEY,"
+                            "size INTEGER,"
+                            "mtime REAL,"
+                            "inode INTEGER,"
+                            "structure TEXT,"
+                            "last_used REAL)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS matches("
+                            "structure_md5 TEXT,"
+                            "top INTEGER,"
+                            "scored_entries INTEGER,"
+                            "catalog_version TEXT,"
+                            "matches TEXT,"
+                            "last_used REAL,"
+                            "PRIMARY KEY (structure_md5, top))")
+
+    def close(self):
+        self.db.close()
+
+    def commit(self):
+        self.db.commit()
+
+    def clear(self):
+        with self.db:
+            self.db.execute("DELETE FROM files")
+            self.db.execute("DELETE FROM matches")
+
+    def evict(self, max_entries):
+        """Drop all but the max_entries most recently used files and rankings."""
+        with self.db:
+            self.db.execute("DELETE FROM files WHERE path NOT IN "
+                            "(SELECT path FROM files ORDER BY last_used DESC LIMIT ?)", (max_entries,))
+            self.db.execute("DELETE FROM matches WHERE rowid NOT IN "
+                            "(SELECT rowid FROM matches ORDER BY last_used DESC LIMIT ?)", (max_entries,))
+
+    def get_structure(self, path, identity):
+        row = self.db.execute("SELECT size, mtime, inode, structure FROM files WHERE path = ?", (path,)).fetchone()
+        if row is None or identity is None or tuple(row[:3]) != identity:
+            return None
+        self.db.execute("UPDATE files SET last_used = ? WHERE path = ?", (time.time(), path))
+        return json.loads(row[3])
+
+    def put_structure(self, path, identity, structure):
+        if identity is None:
+            return
+        self.db.execute("INSERT OR REPLACE INTO files (path, size, mtime, inode, structure, last_used) "
+                        "VALUES (?, ?, ?, ?, ?, ?)", (path,) + identity + (json.dumps(structure), time.time()))
+
+    def get_matches(self, structure_md5, known_catalog, top):
+        """Return the cached top rankings for a structure and the number of catalog entries they cover.
+
+        Returns (None, 0) if there are none, or the catalog has changed other than having entries added.
+        """
+        row = self.db.execute("SELECT scored_entries, catalog_version, matches FROM matches "
+                              "WHERE structure_md5 = ? AND top = ?", (structure_md5, top)).fetchone()
+        if row is None:
+            return None, 0
+        scored_entries, catalog_version, matches = row
+        if not 0 < scored_entries <= len(known_catalog) or \
+                known_catalog.versions[scored_entries - 1] != catalog_version:
+            return None, 0
+        self.db.execute("UPDATE matches SET last_used = ? WHERE structure_md5 = ? AND top = ?",
+                        (time.time(), structure_md5, top))
+        return [{'score': score, 'squid': known_catalog.entries[known_catalog.positions[squid_id]]}
+                for score, squid_id in json.loads(matches)], scored_entries
+
+    def put_matches(self, structure_md5, known_catalog, top, matches):
+        if not len(known_catalog):
+            return
+        self.db.execute("INSERT OR REPLACE INTO matches (structure_md5, top, scored_entries, catalog_version, "
+                        "matches, last_used) VALUES (?, ?, ?, ?, ?, ?)",
+                        (structure_md5, top, len(known_catalog), known_catalog.versions[-1],
+                         json.dumps([[match['score'], match['squid'].squid_id] for match in matches]), time.time()))
+
+
+# Scan caches that have already been opened in this process, keyed by path
+opened_scan_caches = {}
+
+
+def open_scan_cache(cache_path):
+    cache_path = os.path.realpath(cache_path)
+    if cache_path not in opened_scan_caches:
+        opened_scan_caches[cache_path] = ScanCache(cache_path)
+    return opened_scan_caches[cache_path]
+
+
+def walk_files(top):
+    """Yield the path of every non-directory entry under top, streaming them as each directory is listed.
+
+    Files in a directory come before the contents of its subdirectories, in listing order, the same order
+    os.path.walk visits them in.  Symlinked directories are not followed.
+    """
+    scandir = getattr(os, 'scandir', None)
+    try:
+        if scandir:
+            entries = [(entry.name, entry.is_dir(follow_symlinks=False)) for entry in scandir(top)]
+        else:
+            entries = [(name, os.path.isdir(os.path.join(top, name)) and not os.path.islink(os.path.join(top, name)))
+                       for name in os.listdir(top)]
+    except OSError:
+        return
+
+    for name, is_dir in entries:
+        if not is_dir:
+            yield os.path.join(top, name)
+    for name, is_dir in entries:
+        if is_dir:
+            for file_path in walk_files(os.path.join(top, name)):
+                yield file_path
+
+
+def write_message(message_file, value):
+    """Write value to message_file pickled, after its length, in one write."""
+    message = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+    message_file.write(struct.pack('>I', len(message)) + message)
+    message_file.flush()
+
+
+def read_message(message_file):
+    """Read a value written by write_message from message_file, raising EOFError if the file ends first."""
+    header = message_file.read(4)
+    if len(header) < 4:
+        raise EOFError
+    length = struct.unpack('>I', header)[0]
+    message = message_file.read(length)
+    if len(message) < length:
+        raise EOFError
+    return pickle.loads(message)
+
+
+# Extra time a StructureExtractor gives its process over the time limit, since the process stops on its own
+EXTRACTION_GRACE_SECONDS = 1.0
+
+
+class StructureExtractor(object):
+    """Builds files' structures in a separate Python process that is killed if a file takes longer than its time
+    limit, such as one on a stalled network mount, so the scan carries on (with a new process) instead of hanging.
+
+    (path, header_checked) tuples are sent to the process's stdin and (structure, rejected, partial, limit_exceeded,
+    metrics) tuples read back from its stdout, as write_message writes them; see extraction_worker.  Where select()
+    can't wait on pipes (Windows), a thread reads the results instead.
+    """
+
+    def __init__(self, limits):
+        self.limits = limits
+        self.process = None
+        # Where the process copies databases that can't be read in place (see read_only_access), so they can be
+        # removed if it's killed part way through one
+        self.copy_directory = os.path.join(tempfile.gettempdir(), 'squid-{}-{}'.format(os.getpid(), id(self)))
+
+    def start(self):
+        module_directory, module_file = os.path.split(os.path.abspath(__file__))
+        module = os.path.splitext(module_file)[0]
+        code = 'import sys; sys.path.insert(0, {!r}); import {}; {}.extraction_worker({}.{!r}, {!r})'.format(
+            module_directory, module, module, module, self.limits, self.copy_directory)
+        self.process = subprocess.Popen([sys.executable, '-c', code], bufsize=-1, stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE)
+        self.results = None
+        if sys.platform == 'win32':
+            self.results = Queue.Queue()
+            reader = threading.Thread(target=self.read_results, args=(self.process.stdout, self.results))
+            reader.daemon = True
+            reader.start()
+
+    @staticmethod
+    def read_results(results_file, results):
+        try:
+            while True:
+                results.put(read_message(results_file))
+        except (EOFError, IOError, pickle.UnpicklingError):
+            results.put(None)
+
+    def read_result(self, timeout):
+        """Return the next result from the process, or None if there isn't one within timeout seconds."""
+        if self.results:
+            try:
+                return self.results.get(timeout=timeout)
+            except Queue.Empty:
+                return None
+        if not select.select([self.process.stdout], [], [], timeout)[0]:
+            return None
+        try:
+            return read_message(self.process.stdout)
+        except (EOFError, IOError, pickle.UnpicklingError):
+            return None
+
+    def stop(self):
+        if self.process:
+            try:
+                self.process.kill()
+            except OSError:
+                pass
+            self.process.wait()
+            self.process = None
+            shutil.rmtree(self.copy_directory, ignore_errors=True)
+
+    def build_structure(self, candidate, header_checked=False):
+        """Set candidate's structure, rejected, partial and limit_exceeded as candidate.build_structure would."""
+        if self.process is None:
+            self.start()
+        started = time.time()
+        try:
+            write_message(self.process.stdin, (candidate.path, header_checked))
+            result = self.read_result(self.limits.seconds + EXTRACTION_GRACE_SECONDS)
+        except IOError:
+            result = None
+
+        candidate.structure = {}
+        if result is None:
+            timed_out = time.time() - started >= self.limits.seconds
+            self.stop()
+            if timed_out:
+                candidate.exceed_limit('timed out', 'took over {}s'.format(self.limits.seconds), started)
             else:
-                return version_list[0]
+                candidate.record_failure('extract', LimitExceeded('extraction process exited'), started)
+            return
+        candidate.structure, candidate.rejected, candidate.partial, candidate.limit_exceeded, metrics = result
+        scan_metrics.merge(metrics)
+
+
+def extraction_worker(limits, copy_directory=None):
+    """Run in a StructureExtractor's process: build the structure of each path read from stdin until it's closed."""
+    results_file = sys.stdout
+    # Keep anything else printed out of the results
+    sys.stdout = sys.stderr
+    if sys.platform == 'win32':
+        import msvcrt
+        msvcrt.setmode(sys.stdin.fileno(), os.O_BINARY)
+        msvcrt.setmode(results_file.fileno(), os.O_BINARY)
+    while True:
+        try:
+            path, header_checked = read_message(sys.stdin)
+        except EOFError:
+            return
+        candidate = squid(db_name=os.path.basename(path), path=path)
+        candidate.build_structure(limits, header_checked, copy_directory)
+        write_message(results_file, (candidate.structure, candidate.rejected, candidate.partial,
+                                     candidate.limit_exceeded, scan_metrics.take()))
+
+
+# The StructureExtractor each set of limits has in this process, keyed by their repr
+structure_extractors = {}
+
+
+def structure_extractor(limits):
+    if repr(limits) not in structure_extractors:
+        structure_extractors[repr(limits)] = StructureExtractor(limits)
+    return structure_extractors[repr(limits)]
+
+
+def build_candidate_structure(candidate, limits=None, extractor=None):
+    """Build candidate's structure within limits (a FileLimits).  With a time limit, it's built by extractor, or by
+    this process's StructureExtractor for limits if that isn't given, so a file that hangs can be given up on.
+    """
+    if not limits or not limits.seconds:
+        candidate.build_structure(limits)
+        return
+    # Most files in a scan aren't SQLite, and checking the header here is far cheaper than a round trip to the
+    # extractor.  Anything but a regular file (such as a FIFO) could block on open, so that's left to the extractor.
+    header_checked = os.path.isfile(candidate.path)
+    if header_checked:
+        with scan_metrics.timing('sniff'):
+            candidate.rejected = check_sqlite_header(candidate.path)
+    if not candidate.rejected:
+        (extractor or structure_extractor(limits)).build_structure(candidate, header_checked)
+
+
+# Rankings of the structures compare_files has seen most recently, keyed by structure hash and catalog version
+ranked_structures = collections.OrderedDict()
+
+
+def compare_files(file_paths, squid_reference_database, rejections=None, cache=None, top=3, limits=None):
+    """Extract the structure of each file and rank the top SQLite DBs found against the catalog.
+
+    Returns a results entry (as written to a report) for each file that had a structure, or that was over limits
+    (a FileLimits), in the order given.  If a rejections Counter is given, the files skipped by the header check
+    are counted in it by reason.  If a ScanCache is given, structures and rankings are reused from it where they're
+    still valid, and stored in it where they aren't.  With a time limit, structures are built by a
+    StructureExtractor, so a file that hangs can be given up on.
+    """
+    known_catalog = squid_reference_database
+    if isinstance(known_catalog, Catalog):
+        known_catalog.refresh()
+    else:
+        known_catalog = load_catalog(known_catalog)
+
+    candidates = []
+    for file_path in file_paths:
+        scan_metrics.counters['files'] += 1
+        scan_metrics.current_path = file_path
+        candidate = squid(db_name=os.path.basename(file_path), path=file_path)
+        structure = None
+        if cache:
+            identity = file_identity(file_path)
+            structure = cache.get_structure(file_path, identity)
+        if structure is not None:
+            candidate.structure = structure
         else:
-            return version_list
-    workbook = xlsxwriter.Workbook(output + '.xlsx')
-    w = workbook.add_worksheet('Matches')
-
-    # Define cell formats
-    title_header_format  = workbook.add_format({'font_color': 'white', 'bg_color': 'gray', 'bold': 'true'})
-    center_header_format = workbook.add_format({'font_color': 'black', 'align': 'center', 'bg_color': 'gray',
-                                                'bold': 'true'})
-    header_format        = workbook.add_format({'font_color': 'black', 'bg_color': 'gray', 'bold': 'true'})
-    black_percent_format = workbook.add_format({'font_color': 'black', 'num_format': '0.0%', 'left': 1})
-
-    # Title bar
-    w.merge_range('A1:B1', "SQUID (v%s)" % __version__, title_header_format)
-    w.merge_range('C1:G1', 'Match 1', center_header_format)
-    w.merge_range('H1:L1', 'Match 2', center_header_format)
-    w.merge_range('M1:Q1', 'Match 3', center_header_format)
-
-    # Write column headers
-    w.write(1, 0, "Name", header_format)
-    w.write(1, 1, "Path", header_format)
-    w.write(1, 2, "Match%", header_format)
-    w.write(1, 3, "DB Name", header_format)
-    w.write(1, 4, "Program Name", header_format)
-    w.write(1, 5, "Version", header_format)
-    w.write(1, 6, "Category", header_format)
-
-    w.write(1, 7, "Match%", header_format)
-    w.write(1, 8, "DB Name", header_format)
-    w.write(1, 9, "Program Name", header_format)
-    w.write(1, 10, "Version", header_format)
-    w.write(1, 11, "Category", header_format)
-
-    w.write(1, 12, "Match%", header_format)
-    w.write(1, 13, "DB Name", header_format)
-    w.write(1, 14, "Program Name", header_format)
-    w.write(1, 15, "Version", header_format)
-    w.write(1, 16, "Category", header_format)
-
-    #Set column widths
-    w.set_column('A:A', 25)                         # Name
-    w.set_column('B:B', 35)                         # Path
-
-                                                    # Match 1
-    w.set_column('C:C', 8, black_percent_format)    # Match %
-    w.set_column('D:D', 20)                         # DB Name
-    w.set_column('E:E', 16)                         # Program Name
-    w.set_column('F:F', 10)                         # Program Version
-    w.set_column('G:G', 15)                         # Program Family
-
-                                                    # Match 2
-    w.set_column('H:H', 8, black_percent_format)    # Match %
-    w.set_column('I:I', 20)                         # DB Name
-    w.set_column('J:J', 16)                         # Program Name
-    w.set_column('K:K', 10)                         # Program Version
-    w.set_column('L:L', 15)                         # Program Family
-
-                                                    # Match 3
-    w.set_column('M:M', 8, black_percent_format)    # Match %
-    w.set_column('N:N', 20)                         # DB Name
-    w.set_column('O:O', 16)                         # Program Name
-    w.set_column('P:P', 10)                         # Program Version
-    w.set_column('Q:Q', 15)                         # Program Family
+            build_candidate_structure(candidate, limits)
+            # Partial structures, and files over the limits, aren't cached, so they're tried again next time
+            if cache and not candidate.rejected and not candidate.partial and not candidate.limit_exceeded:
+                cache.put_structure(file_path, identity, candidate.structure)
+        if candidate.limit_exceeded:
+            candidates.append(candidate)
+        elif candidate.structure != {}:
+            candidates.append(candidate)
+            scan_metrics.counters['partial' if candidate.partial else 'databases'] += 1
+        elif candidate.rejected:
+            scan_metrics.counters['rejected'] += 1
+            if rejections is not None:
+                rejections[candidate.rejected] += 1
+    scan_metrics.current_path = None
+    return rank_candidates(candidates, known_catalog, cache, top)
+
+
+def rank_candidates(candidates, known_catalog, cache=None, top=3):
+    """Rank the top SQLite DBs in known_catalog for each candidate squid, returning a results entry for each.
+
+    Candidates that were over their limits aren't ranked; their entries have no matches and the limit as status.
+    """
+    # Candidates with the same structure are only ranked once per scan.  Use the rankings from earlier in the scan
+    # or from the cache where there are some.  Structures identical to top or more catalog entries aren't scored at
+    # all, and the catalog entries a structure is identical to are never scored.
+    all_candidates = candidates
+    candidates = [candidate for candidate in all_candidates if not candidate.limit_exceeded]
+    structure_md5s = [structure_hash(candidate.structure) for candidate in candidates]
+    catalog_version = (known_catalog.path, known_catalog.versions[-1] if known_catalog.versions else None, top,
+                       known_catalog.prefilter, known_catalog.fuzzy)
+    rankings = {}
+    unscored = []
+    for candidate, structure_md5 in zip(candidates, structure_md5s):
+        if structure_md5 in rankings:
+            continue
+        rankings[structure_md5] = None
+
+        if (structure_md5, catalog_version) in ranked_structures:
+            rankings[structure_md5] = ranked_structures.pop((structure_md5, catalog_version))
+        elif len(known_catalog.structure_hashes.get(structure_md5, ())) >= top:
+            rankings[structure_md5] = [{'score': 100.0, 'squid': known_catalog.entries[position]}
+                                         for position in known_catalog.structure_hashes[structure_md5][:top]]
+        elif cache and not known_catalog.fuzzy:
+            # If cached rankings don't cover the whole catalog, only score the entries added since.  The cache only
+            # holds exact rankings, so with the prefilter on it's just read from, and with fuzzy scoring not at all.
+            previous_matches, scored_entries = cache.get_matches(structure_md5, known_catalog, top)
+            if previous_matches is not None and scored_entries == len(known_catalog):
+                rankings[structure_md5] = previous_matches
+            elif previous_matches is not None and not known_catalog.prefilter:
+                rankings[structure_md5] = compare_to_known(
+                    candidate, known_catalog, verbose=False, previous_matches=previous_matches,
+                    first_position=scored_entries, top=top,
+                    identical_positions=known_catalog.structure_hashes.get(structure_md5, ()))
+                cache.put_matches(structure_md5, known_catalog, top, rankings[structure_md5])
+
+        if rankings[structure_md5] is None:
+            unscored.append((candidate, structure_md5))
+
+    # With the prefilter on, only the entries it picks for each candidate are scored, and fuzzy scores are worked out
+    # pair by pair; otherwise score the rest of the candidates against the whole catalog in one batch
+    with scan_metrics.timing('score'), scan_metrics.profiling():
+        if known_catalog.prefilter or known_catalog.fuzzy:
+            for candidate, structure_md5 in unscored:
+                rankings[structure_md5] = compare_to_known(
+                    candidate, known_catalog, verbose=False, top=top,
+                    identical_positions=known_catalog.structure_hashes.get(structure_md5, ()))
+        else:
+            batch_scores = compare_batch([candidate for candidate, structure_md5 in unscored], known_catalog)
+            for (candidate, structure_md5), scores in zip(unscored, batch_scores):
+                rankings[structure_md5] = compare_to_known(
+                    candidate, known_catalog, scores, verbose=False, top=top,
+                    identical_positions=known_catalog.structure_hashes.get(structure_md5, ()))
+                if cache:
+                    cache.put_matches(structure_md5, known_catalog, top, rankings[structure_md5])
+
+    if cache:
+        cache.commit()
+
+    for structure_md5 in structure_md5s:
+        # Keep the most recently seen structures' rankings for the rest of the scan
+        ranked_structures[(structure_md5, catalog_version)] = rankings[structure_md5]
+        while len(ranked_structures) > RANKED_STRUCTURES_SIZE:
+            ranked_structures.popitem(last=False)
+
+    file_results = []
+    structure_md5s = iter(structure_md5s)
+    for candidate in all_candidates:
+        if candidate.limit_exceeded:
+            file_results.append({'file_name': candidate.db_name, 'file_path': candidate.path, 'structure_md5': None,
+                                 'matches': [], 'status': candidate.limit_exceeded})
+            continue
+        structure_md5 = next(structure_md5s)
+        file_results.append({'file_name': candidate.db_name, 'file_path': candidate.path,
+                             'structure_md5': structure_md5, 'matches': rankings[structure_md5],
+                             'status': 'partial' if candidate.partial else None})
+    return file_results
+
+
+def compare_files_worker(file_paths, catalog_path, cache_path=None, top=3, limits=None):
+    rejections = collections.Counter()
+    cache = open_scan_cache(cache_path) if cache_path else None
+    file_results = compare_files(file_paths, catalog_path, rejections, cache, top, limits)
+    # Send back copies of the matched squids without their structures; only the program details are reported
+    for file_result in file_results:
+        file_result['matches'] = [
+            {'score': match['score'],
+             'squid': squid(match['squid'].db_name, path=match['squid'].path,
+                            program_family=match['squid'].program_family, program_name=match['squid'].program_name,
+                            program_version=match['squid'].program_version, squid_id=match['squid'].squid_id)}
+            for match in file_result['matches']]
+    scan_metrics.save_profile()
+    return file_results, rejections, scan_metrics.take()
+
+
+def start_compare_worker(catalog_path, prefilter=None, fuzzy=False, profile_path=None):
+    """Set up a compare_directory worker process: load the catalog, and profile its scoring if asked to."""
+    load_catalog(catalog_path, prefilter, fuzzy)
+    if profile_path:
+        scan_metrics.start_profiling('{}.{}'.format(profile_path, os.getpid()))
+
+
+def compare_directory(directory, catalog_path, jobs=1, rejections=None, cache_path=None, top=3, prefilter=None,
+                      limits=None, fuzzy=False):
+    """Walk directory and compare every file in it to the catalog, yielding results entries as they are ready.
+
+    With more than one job, batches of files are handed to a pool of worker processes (each loading the catalog
+    once).  Only a few batches per worker are queued at a time, and results are yielded in walk order, so the
+    output is the same as scanning with a single job.  Files rejected by the header check are counted in
+    rejections, if given.  If cache_path is given, that ScanCache is used by whichever process does the comparing.
+    prefilter is the (bands, rows) of the catalog's MinHash prefilter, if it should be used, limits the
+    FileLimits each file is read within, and fuzzy whether to score with compare_dbs_fuzzy.  Each stage is timed
+    in scan_metrics, with the metrics from the workers merged in as their batches are collected.
+    """
+    if rejections is None:
+        rejections = collections.Counter()
+
+    def batches():
+        batch = []
+        walk = walk_files(directory)
+        while True:
+            with scan_metrics.timing('walk'):
+                file_path = next(walk, None)
+            if file_path is None:
+                break
+            batch.append(file_path)
+            if len(batch) >= COMPARE_BATCH_SIZE:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    if jobs <= 1:
+        known_catalog = load_catalog(catalog_path, prefilter, fuzzy)
+        cache = open_scan_cache(cache_path) if cache_path else None
+        for batch in batches():
+            for file_result in compare_files(batch, known_catalog, rejections, cache, top, limits):
+                yield file_result
+        return
+
+    def collect(async_result):
+        file_results, batch_rejections, batch_metrics = async_result.get()
+        rejections.update(batch_rejections)
+        scan_metrics.merge(batch_metrics)
+        return file_results
+
+    pool = multiprocessing.Pool(jobs, initializer=start_compare_worker,
+                                initargs=(catalog_path, prefilter, fuzzy, scan_metrics.profile_path))
+    pending = collections.deque()
+    try:
+        for batch in batches():
+            pending.append(pool.apply_async(compare_files_worker, (batch, catalog_path, cache_path, top, limits)))
+            if len(pending) >= jobs * 2:
+                for file_result in collect(pending.popleft()):
+                    yield file_result
+        while pending:
+            for file_result in collect(pending.popleft()):
+                yield file_result
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+# SQLite DBs are looked for at every multiple of this many bytes in raw files; files, and so the DBs in them, start
+# on sector boundaries, even once they're only in unallocated space
+CARVE_ALIGNMENT = 512
+# Raw files are searched through a window this big mapped at a time, so memory use doesn't grow with their size
+CARVE_WINDOW_SIZE = 64 * 1024 * 1024
+
+
+def find_embedded_databases(image_path):
+    """Yield the offset of each SQLite header magic string on a CARVE_ALIGNMENT boundary in the file at image_path."""
+    with open(image_path, 'rb') as image:
+        size = os.fstat(image.fileno()).st_size
+        window_start = 0
+        while window_start < size:
+            length = min(CARVE_WINDOW_SIZE, size - window_start)
+            window = mmap.mmap(image.fileno(), length, access=mmap.ACCESS_READ, offset=window_start)
+            try:
+                position = window.find(SQLITE_HEADER_MAGIC)
+                while position != -1:
+                    if position % CARVE_ALIGNMENT == 0:
+                        yield window_start + position
+                    position = window.find(SQLITE_HEADER_MAGIC, position + 1)
+            finally:
+                window.close()
+            window_start += length
+
+
+def embedded_structure(image, offset):
+    """Return the structure of the SQLite DB at offset in the open file image, read from its pages in place."""
+    map_start = offset - offset % mmap.ALLOCATIONGRANULARITY
+    buffer = mmap.mmap(image.fileno(), os.fstat(image.fileno()).st_size - map_start, access=mmap.ACCESS_READ,
+                       offset=map_start)
+    try:
+        return RawDatabase(buffer, offset - map_start).structure()
+    finally:
+        buffer.close()
+
+
+def compare_image(image_path, catalog_path, rejections=None, top=3, prefilter=None, fuzzy=False):
+    """Find the SQLite DBs embedded anywhere in a raw file and compare each to the catalog, yielding results entries.
+
+    Disk images, unallocated space and other blobs are searched through a window at a time, and each DB found is
+    read from its pages in place rather than copied out, so memory use stays bounded however big the file is.
+    Headers that turn out not to be valid, and DBs whose schema can't be read, are counted in rejections, if given.
+    """
+    if rejections is None:
+        rejections = collections.Counter()
+    known_catalog = load_catalog(catalog_path, prefilter, fuzzy)
+
+    candidates = []
+    with open(image_path, 'rb') as image:
+        for offset in find_embedded_databases(image_path):
+            image.seek(offset)
+            problem = sqlite_header_problem(image.read(SQLITE_HEADER_SIZE))
+            if problem:
+                rejections[problem] += 1
+                continue
+            candidate = squid(db_name='{} @ {}'.format(os.path.basename(image_path), offset), path=image_path)
+            try:
+                candidate.structure = embedded_structure(image, offset)
+            except RAW_DATABASE_ERRORS:
+                rejections['unreadable schema'] += 1
+                continue
+            if candidate.structure != {}:
+                candidates.append(candidate)
+
+            if len(candidates) >= COMPARE_BATCH_SIZE:
+                for file_result in rank_candidates(candidates, known_catalog, top=top):
+                    yield file_result
+                candidates = []
+    for file_result in rank_candidates(candidates, known_catalog, top=top):
+        yield file_result
+
+
+def friendly_version(version_json):
+    version_list = json.loads(version_json)
+    if isinstance(version_list, list):
+        if len(version_list) > 1:
+            return str(version_list[0]) + " - " + str(version_list[-1])
+        else:
+            return version_list[0]
+    else:
+        return version_list
+
+
+def match_details(match):
+    """Return the (db_name, program_name, program_version, program_family) to report for a match."""
+    # Matched squids are shared catalog entries, so blank out non-matches here rather than on the squid
+    if match['score'] == 0.0:
+        return '-', '-', "[\"-\"]", '-'
+    known_db = match['squid']
+    return known_db.db_name, known_db.program_name, known_db.program_version, known_db.program_family
+
+
+class XlsxReport(object):
+    """Writes results entries to an XLSX report a row at a time, with a group of columns for each of the top matches.
+
+    The workbook is written in xlsxwriter's constant_memory mode, so each row is flushed to disk once the next is
+    started and memory use doesn't grow with the number of results.
+    """
+    extension = '.xlsx'
+
+    def __init__(self, output, top=3):
+        self.path = output + self.extension
+        self.top = top
+        self.workbook = xlsxwriter.Workbook(self.path, {'constant_memory': True})
+        w = self.worksheet = self.workbook.add_worksheet('Matches')
+
+        # Define cell formats
+        title_header_format  = self.workbook.add_format({'font_color': 'white', 'bg_color': 'gray', 'bold': 'true'})
+        center_header_format = self.workbook.add_format({'font_color': 'black', 'align': 'center', 'bg_color': 'gray',
+                                                         'bold': 'true'})
+        header_format        = self.workbook.add_format({'font_color': 'black', 'bg_color': 'gray', 'bold': 'true'})
+        black_percent_format = self.workbook.add_format({'font_color': 'black', 'num_format': '0.0%', 'left': 1})
+
+        # Title bar
+        w.merge_range('A1:B1', "SQUID (v%s)" % __version__, title_header_format)
+        for match_number in range(top):
+            first_column = 2 + match_number * 5
+            w.merge_range(0, first_column, 0, first_column + 4, 'Match {}'.format(match_number + 1),
+                          center_header_format)
+
+        # Write column headers
+        w.write(1, 0, "Name", header_format)
+        w.write(1, 1, "Path", header_format)
+        for match_number in range(top):
+            first_column = 2 + match_number * 5
+            w.write(1, first_column, "Match%", header_format)
+            w.write(1, first_column + 1, "DB Name", header_format)
+            w.write(1, first_column + 2, "Program Name", header_format)
+            w.write(1, first_column + 3, "Version", header_format)
+            w.write(1, first_column + 4, "Category", header_format)
+        self.schema_group_column = 2 + top * 5
+        w.write(1, self.schema_group_column, "Schema Group", header_format)
+        self.status_column = self.schema_group_column + 1
+        w.write(1, self.status_column, "Status", header_format)
+
+        #Set column widths
+        w.set_column('A:A', 25)                                             # Name
+        w.set_column('B:B', 35)                                             # Path
+        for match_number in range(top):
+            first_column = 2 + match_number * 5
+            w.set_column(first_column, first_column, 8, black_percent_format)   # Match %
+            w.set_column(first_column + 1, first_column + 1, 20)                # DB Name
+            w.set_column(first_column + 2, first_column + 2, 16)                # Program Name
+            w.set_column(first_column + 3, first_column + 3, 10)                # Program Version
+            w.set_column(first_column + 4, first_column + 4, 15)                # Program Family
+        # Structure MD5 shared by files with identical schemas
+        w.set_column(self.schema_group_column, self.schema_group_column, 34)
+        # "partial" if the structure was recovered from a damaged DB's raw pages
+        w.set_column(self.status_column, self.status_column, 10)
+
+        self.row_number = 2
+
+    def write(self, item):
+        w = self.worksheet
+        w.write(self.row_number, 0, item['file_name'])
+        w.write(self.row_number, 1, item['file_path'])
+        for counter, match in enumerate(item['matches']):
+            first_column = 2 + counter * 5
+            db_name, program_name, program_version, program_family = match_details(match)
+            w.write(self.row_number, first_column, match['score'] / 100)
+            w.write(self.row_number, first_column + 1, db_name)
+            w.write(self.row_number, first_column + 2, program_name)
+            w.write(self.row_number, first_column + 3, friendly_version(program_version))
+            w.write(self.row_number, first_column + 4, program_family)
+        w.write(self.row_number, self.schema_group_column, item['structure_md5'])
+        if item.get('status'):
+            w.write(self.row_number, self.status_column, item['status'])
+
+        self.row_number += 1
+
+    def close(self):
+        # Formatting
+        self.worksheet.freeze_panes(2, 0)                                           # Freeze top row
+        self.worksheet.autofilter(1, 0, self.row_number, self.status_column)        # Add autofilter
+
+        self.workbook.close()
+
+
+class CsvReport(object):
+    """Writes results entries to a CSV report, with the same columns as the XLSX one, flushing every row."""
+    extension = '.csv'
+
+    def __init__(self, output, top=3):
+        self.path = output + self.extension
+        self.top = top
+        self.report_file = open(self.path, 'wb')
+        self.writer = csv.writer(self.report_file)
+        header = ['Name', 'Path']
+        for match_number in range(1, top + 1):
+            header += ['Match {} %'.format(match_number), 'Match {} DB Name'.format(match_number),
+                       'Match {} Program Name'.format(match_number), 'Match {} Version'.format(match_number),
+                       'Match {} Category'.format(match_number)]
+        header += ['Schema Group', 'Status']
+        self.writer.writerow(header)
+
+    def write(self, item):
+        row = [item['file_name'], item['file_path']]
+        for match in item['matches']:
+            db_name, program_name, program_version, program_family = match_details(match)
+            row += [match['score'], db_name, program_name, friendly_version(program_version), program_family]
+        row += [''] * (2 + self.top * 5 - len(row))
+        row += [item['structure_md5'], item.get('status') or '']
+        self.writer.writerow([value.encode('utf-8') if isinstance(value, unicode) else value for value in row])
+        self.report_file.flush()
+
+    def close(self):
+        self.report_file.close()
+
+
+def result_summary(item):
+    """Return a results entry as plain JSON-able values, with the program details of each match.
+
+    Matches that scored 0 are left out rather than named, as the XLSX and CSV reports blank them (see match_details).
+    """
+    matches = []
+    for match in item['matches']:
+        if match['score'] == 0.0:
+            continue
+        known_db = match['squid']
+        matches.append({'score': match['score'], 'squid_id': known_db.squid_id, 'db_name': known_db.db_name,
+                        'program_name': known_db.program_name,
+                        'program_version': json.loads(known_db.program_version),
+                        'program_family': known_db.program_family})
+    return {'file_name': item['file_name'], 'file_path': item['file_path'], 'structure_md5': item['structure_md5'],
+            'status': item.get('status'), 'matches': matches}
+
+
+class JsonLinesReport(object):
+    """Writes each results entry as a line of JSON, flushing every line."""
+    extension = '.jsonl'
+
+    def __init__(self, output, top=3):
+        self.path = output + self.extension
+        self.report_file = open(self.path, 'wb')
+
+    def write(self, item):
+        self.report_file.write(json.dumps(result_summary(item)) + '\n')
+        self.report_file.flush()
+
+    def close(self):
+        self.report_file.close()
+
+
+report_formats = {'xlsx': XlsxReport, 'csv': CsvReport, 'jsonl': JsonLinesReport}
+
+
+def extract_structure(path, limits=None, extractor=None):
+    """Return the structure of the file at path, why it was rejected (if it was), whether it's partial, and which
+    of limits (a FileLimits) it was over, if any.  See build_candidate_structure for extractor.
+    """
+    candidate = squid(path=path)
+    build_candidate_structure(candidate, limits, extractor)
+    return candidate.structure, candidate.rejected, candidate.partial, candidate.limit_exceeded
+
+
+def structure_problem(structure):
+    """Return None if structure is shaped like the ones build_structure makes, otherwise what's wrong with it."""
+    if not isinstance(structure, dict):
+        return 'structure must be an object of tables'
+    for table, columns in structure.items():
+        if not isinstance(columns, dict):
+            return 'table {} must be an object of columns'.format(json.dumps(table))
+        for column, attributes in columns.items():
+            if not isinstance(attributes, dict) or any(attribute not in attributes for attribute in ATTRIBUTES):
+                return 'column {}.{} must be an object with {}'.format(json.dumps(table), json.dumps(column),
+                                                                    ', '.join(ATTRIBUTES))
+            if not isinstance(attributes['type'], basestring) or \
+                    any(isinstance(attributes[attribute], (dict, list)) for attribute in ATTRIBUTES):
+                return 'column {}.{} must have a string type, and a not_null and default_value that are ' \
+                       'strings, numbers or null'.format(json.dumps(table), json.dumps(column))
+    return None
+
+
+class CompareService(object):
+    """Compares files or structures sent to a --serve process against a catalog kept loaded between requests.
+
+    Structures are extracted in a pool of jobs worker processes (or in the request's own thread with one job), so
+    a slow file doesn't hold up other requests, while ranking is done one request at a time against the shared
+    catalog.  The catalog is refreshed before each ranking, so entries added with --learn are used straight away.
+    With a time limit, each extraction runs in a StructureExtractor, as in a scan; with one job, idle extractors are
+    kept in extractors for the next request, since requests' threads can't share one.
+    """
+
+    def __init__(self, catalog_path, jobs=1, top=3, prefilter=None, limits=None, fuzzy=False):
+        self.catalog_path = catalog_path
+        self.top = top
+        self.prefilter = prefilter
+        self.limits = limits
+        self.fuzzy = fuzzy
+        self.lock = threading.Lock()
+        self.pool = multiprocessing.Pool(jobs) if jobs > 1 else None
+        self.extractors = Queue.Queue()
+        load_catalog(catalog_path, prefilter, fuzzy)
+
+    def extract(self, path):
+        if self.pool:
+            return self.pool.apply(extract_structure, (path, self.limits))
+        if not self.limits or not self.limits.seconds:
+            return extract_structure(path, self.limits)
+        try:
+            extractor = self.extractors.get_nowait()
+        except Queue.Empty:
+            extractor = StructureExtractor(self.limits)
+        try:
+            return extract_structure(path, self.limits, extractor)
+        finally:
+            self.extractors.put(extractor)
+
+    def compare(self, request):
+        """Return the response to a compare request: a dict with a path or a structure, and optionally top."""
+        top = int(request.get('top', self.top))
+        if top < 1:
+            raise ValueError('top must be at least 1')
+        if not isinstance(request.get('name') or '', basestring):
+            raise ValueError('name must be a string')
+        if 'structure' in request:
+            structure = request['structure']
+            problem = structure_problem(structure)
+            if problem:
+                raise ValueError(problem)
+            candidate = squid(db_name=request.get('name'), structure=structure)
+        elif 'path' in request:
+            path = request['path']
+            if not isinstance(path, basestring) or not path:
+                raise ValueError('path must be a non-empty string')
+            candidate = squid(db_name=request.get('name') or os.path.basename(path), path=path)
+            (candidate.structure, candidate.rejected, candidate.partial,
+             candidate.limit_exceeded) = self.extract(path)
+            if candidate.structure == {}:
+                return {'file_name': candidate.db_name, 'file_path': path, 'structure_md5': None,
+                        'status': candidate.rejected or candidate.limit_exceeded or 'no tables', 'matches': []}
+        else:
+            raise ValueError('a path or a structure is needed')
+
+        with self.lock:
+            known_catalog = load_catalog(self.catalog_path, self.prefilter, self.fuzzy)
+            return result_summary(rank_candidates([candidate], known_catalog, top=top)[0])
+
+    def status(self):
+        with self.lock:
+            known_catalog = load_catalog(self.catalog_path, self.prefilter, self.fuzzy)
+            return {'squid_version': __version__, 'catalog': known_catalog.path, 'entries': len(known_catalog),
+                    'catalog_version': known_catalog.versions[-1] if known_catalog.versions else None}
+
+    def close(self):
+        if self.pool:
+            self.pool.terminate()
+            self.pool.join()
+        while not self.extractors.empty():
+            self.extractors.get_nowait().stop()
+
+
+class CompareRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Answers POST /compare with the top matches as JSON, and GET /status with the loaded catalog's details."""
+    server_version = 'SQUID/' + __version__
+
+    def do_GET(self):
+        if self.path != '/status':
+            return self.send_json(404, {'error': 'not found'})
+        self.send_json(200, self.server.compare_service.status())
+
+    def do_POST(self):
+        if self.path != '/compare':
+            return self.send_json(404, {'error': 'not found'})
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.getheader('content-length') or 0)))
+            if not isinstance(request, dict):
+                raise ValueError('the request must be a JSON object')
+            response = self.server.compare_service.compare(request)
+        except (ValueError, TypeError) as error:
+            return self.send_json(400, {'error': str(error)})
+        except Exception as error:
+            # Answer rather than leave the client with an empty reply
+            self.log_error('compare failed: %r', error)
+            return self.send_json(500, {'error': 'compare failed'})
+        self.send_json(200, response)
+
+    def send_json(self, code, body):
+        body = json.dumps(body)
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # Unix socket clients don't have an address
+        return self.client_address[0] if self.client_address else 'unix socket'
+
+    def log_message(self, format, *args):
+        sys.stderr.write("{} - - [{}] {}\n".format(self.address_string(), self.log_date_time_string(), format % args))
+
+
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    request_queue_size = 64
+
+
+class ThreadingUnixHTTPServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+    request_queue_size = 64
+
+
+def serve(address, compare_service):
+    """Serve compare requests on address, either "unix:PATH" for a Unix socket or "[HOST:]PORT", until Ctrl-C.
+
+    HOST defaults to 127.0.0.1, as there's no authentication; anything that can connect can read files as SQUID.
+    """
+    if address.startswith('unix:'):
+        socket_path = address[len('unix:'):]
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = ThreadingUnixHTTPServer(socket_path, CompareRequestHandler)
+    else:
+        socket_path = None
+        host, _, port = address.rpartition(':')
+        server = ThreadingHTTPServer((host or '127.0.0.1', int(port)), CompareRequestHandler)
+    server.compare_service = compare_service
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        compare_service.close()
+        if socket_path and os.path.exists(socket_path):
+            os.remove(socket_path)
+
+
+def format_duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return '{}:{:02}:{:02}'.format(hours, minutes, seconds)
+
+
+class ProgressReporter(threading.Thread):
+    """Writes how far a scan of directory has got to stderr every interval seconds, until stop() is called.
+
+    The files in directory are counted alongside the scan, so the percentage done and ETA appear once that's
+    finished.  When the scan runs in this process, the file being read is shown too, so a file the scan is stuck on
+    stands out.  On a terminal the line is rewritten in place; otherwise a new line is written each time.
+    """
+
+    def __init__(self, directory, interval=1.0):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.directory = directory
+        self.interval = interval
+        self.total = None
+        self.stopped = threading.Event()
+        self.started = time.time()
+        self.width = 0
+
+    def count_files(self):
+        total = 0
+        for _ in walk_files(self.directory):
+            if self.stopped.is_set():
+                return
+            total += 1
+        self.total = total
+
+    def run(self):
+        counter = threading.Thread(target=self.count_files)
+        counter.daemon = True
+        counter.start()
+        while not self.stopped.wait(self.interval):
+            self.write()
+        self.write()
+        if sys.stderr.isatty():
+            sys.stderr.write('\n')
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+    def write(self):
+        done = scan_metrics.counters['files']
+        elapsed = time.time() - self.started
+        rate = done / elapsed if elapsed else 0.0
+        if self.total:
+            parts = ['{}/{} files ({:.0%})'.format(done, self.total, min(1.0, float(done) / self.total))]
+        else:
+            parts = ['{} files'.format(done)]
+        parts.append('{:.1f} files/s'.format(rate))
+        if self.total and rate:
+            parts.append('ETA {}'.format(format_duration(max(0, self.total - done) / rate)))
+        failures = sum(scan_metrics.failures.values())
+        if failures:
+            parts.append('{} unreadable'.format(failures))
+        current_path = scan_metrics.current_path
+        if current_path:
+            parts.append(current_path)
+        line = ' ' + ', '.join(parts)
+        if sys.stderr.isatty():
+            sys.stderr.write('\r' + line.ljust(self.width))
+            self.width = len(line)
+        else:
+            sys.stderr.write(line + '\n')
+        sys.stderr.flush()
 
-    print
-    print textwrap.fill("Writing match details to \"{}.xlsx\".".format(output), width=75,
+
+SHORT_COLUMNS = "{:>25}  {:>5}%  {:<25} {:<18}"
+
+
+def report_results(file_results, report, top):
+    """Write each results entry to report as it is produced, printing the high-confidence matches, then close it."""
+    print textwrap.fill("Below are any high-confidence (90+%) matches; a complete list of the top {} matches"
+                        " for each SQLite DB is in \"{}\".".format(top, report.path), width=75,
                         initial_indent=" ", subsequent_indent=" ")
-    row_number = 2
-    for item in results:
-        for counter, match in enumerate(item['top_three']):
-            if item['top_three'][counter]['score'] == 0.0:
-                item['top_three'][counter]['squid'].db_name = '-'
-                item['top_three'][counter]['squid'].program_name = '-'
-                item['top_three'][counter]['squid'].program_version = "[\"-\"]"
-                item['top_three'][counter]['squid'].program_family = '-'
-        w.write(row_number, 0, item['file_name'])
-        w.write(row_number, 1, item['file_path'])
-        w.write(row_number, 2, item['top_three'][0]['score'] / 100)
-        w.write(row_number, 3, item['top_three'][0]['squid'].db_name)
-        w.write(row_number, 4, item['top_three'][0]['squid'].program_name)
-        w.write(row_number, 5, friendly_version(item['top_three'][0]['squid'].program_version))
-        w.write(row_number, 6, item['top_three'][0]['squid'].program_family)
-        w.write(row_number, 7, item['top_three'][1]['score'] / 100)
-        w.write(row_number, 8, item['top_three'][1]['squid'].db_name)
-        w.write(row_number, 9, item['top_three'][1]['squid'].program_name)
-        w.write(row_number, 10, friendly_version(item['top_three'][1]['squid'].program_version))
-        w.write(row_number, 11, item['top_three'][1]['squid'].program_family)
-        w.write(row_number, 12, item['top_three'][2]['score'] / 100)
-        w.write(row_number, 13, item['top_three'][2]['squid'].db_name)
-        w.write(row_number, 14, item['top_three'][2]['squid'].program_name)
-        w.write(row_number, 15, friendly_version(item['top_three'][2]['squid'].program_version))
-        w.write(row_number, 16, item['top_three'][2]['squid'].program_family)
-
-        row_number += 1
-
-    # Formatting
-    w.freeze_panes(2, 0)                # Freeze top row
-    w.autofilter(1, 0, row_number, 16)  # Add autofilter
-
-    workbook.close()
+    print "\n"
+    print '-' * 78
+    print(SHORT_COLUMNS.format('Candidate SQLite DB', 'Match', 'Known DB Name', 'Known Program'))
+    print '-' * 78
+    # Results go straight into the report, so an interrupted scan still leaves one with everything so far
+    try:
+        for file_result in file_results:
+            with scan_metrics.timing('report'):
+                report.write(file_result)
+            # If the match is over 90%, just print
+            if file_result['matches'] and file_result['matches'][0]['score'] > 90:
+                print_short_comparison(file_result['matches'][0]['score'],
+                                       file_result['matches'][0]['squid'], file_result['file_name'])
+    except KeyboardInterrupt:
+        print '-' * 78
+        print
+        print textwrap.fill("Scan interrupted; the report only has the SQLite DBs found so far.", width=75,
+                            initial_indent=" ", subsequent_indent=" ")
+    finally:
+        report.close()
+    print '-' * 78
+
+
+def start_scan_metrics(profile_path=None):
+    scan_metrics.reset()
+    if profile_path:
+        scan_metrics.start_profiling(profile_path)
+
+
+def finish_scan_metrics(metrics_path=None):
+    """Save the scan's profile, if there is one, and write its metrics to metrics_path, if given."""
+    scan_metrics.save_profile()
+    if metrics_path:
+        with open(metrics_path, 'w') as metrics_file:
+            json.dump(scan_metrics.summary(), metrics_file, indent=2, sort_keys=True)
 
 
 def parse_args():
@@ -442,11 +3294,32 @@ def parse_args():
                                  'be compared. If -c points to a directory, the contents of that directory and all '
                                  'subdirectories will be scanned and compared.')
 
+    main_group.add_argument('--carve',
+                            help='Search a raw file, such as a disk image or a dump of unallocated space, for SQLite '
+                                 'databases embedded anywhere in it, and compare each one found to the catalog.  If '
+                                 '--carve points to a directory, every file in it and its subdirectories is searched.')
+    main_group.add_argument('--serve', metavar='ADDRESS',
+                            help='Keep the catalog loaded and answer compare requests over HTTP until stopped with '
+                                 'Ctrl-C.  ADDRESS is "unix:PATH" for a Unix socket or "[HOST:]PORT" for TCP (HOST '
+                                 'defaults to 127.0.0.1).  POST a JSON object with a "path" (or a pre-extracted '
+                                 '"structure") and optionally "top" to /compare to get the top matches back as JSON.')
     main_group.add_argument('-l', '--learn',
                             help='Learn the structure of the indicated database(s) and add to catalog. If -l points to '
                                  'a file, just that single database will be added. If -l points to a directory, the '
                                  'contents of that directory will be scanned and added. Subdirectories will NOT '
                                  'be added.')
+    main_group.add_argument('--learn-batch',
+                            help='Learn every database listed in a manifest (a CSV or JSON file of path, program, '
+                                 'version and family) or found in a directory tree, without asking any questions.  '
+                                 'With a directory, -f, -p and -v apply to all of its databases.')
+    main_group.add_argument('--merge-catalog', metavar='OTHER',
+                            help='Merge another SQUID catalog (such as a colleague\'s catalog.sqlite) into this '
+                                 'one: entries with the same structure and program get any versions they\'re '
+                                 'missing, and the rest are added.')
+    parser.add_argument('--duplicates', choices=['merge', 'new', 'skip'], default='merge',
+                        help='What --learn-batch does with a structure already in the catalog: add the version to '
+                             'the entry for the same program ("merge", the default), add a new entry ("new"), or '
+                             'leave it out ("skip").')
     parser.add_argument('-n', '--name',
                         help='Name of the database from --learn.  If -n is not given, the name of SQLite '
                              'file from -l will be entered in the catalog.')
@@ -456,15 +3329,73 @@ def parse_args():
                         help='Program the database is associated with.  Use with --learn')
     parser.add_argument('-v', '--version',
                         help='Version of the program the database is associated with.  Use with --learn')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='Number of worker processes to use when --compare points to a directory, or '
+                             'for --learn-batch or --serve (default: 1)')
+    parser.add_argument('-t', '--top', type=int, default=3,
+                        help='Number of best matches to find and report for each SQLite DB, at least 1 (default: 3)')
+    parser.add_argument('--prefilter', action='store_true',
+                        help='Only score the catalog entries a MinHash/LSH index of table and column names finds '
+                             'similar to each SQLite DB, instead of every entry sharing a table with it.  Faster on '
+                             'large catalogs, but a match can occasionally be missed.')
+    parser.add_argument('--lsh-bands', type=int, default=16,
+                        help='Number of LSH bands for --prefilter; more find more matches but score more entries '
+                             '(default: 16)')
+    parser.add_argument('--lsh-rows', type=int, default=2,
+                        help='Number of MinHash rows in each LSH band for --prefilter; more score fewer entries but '
+                             'miss more matches (default: 2)')
+    parser.add_argument('--fuzzy', action='store_true',
+                        help='Score near misses too: column types match if SQLite gives them the same affinity '
+                             '(INT and INTEGER, VARCHAR(255) and TEXT), and tables and columns with nearly the same '
+                             'name (urls and url) count for part of the weight of an exact match.')
+    parser.add_argument('--cache', choices=['use', 'rebuild', 'bypass'], default='bypass',
+                        help='Reuse structures and matches from earlier --compare runs of a directory ("use"), '
+                             'discard them and start again ("rebuild"), or don\'t cache at all ("bypass", the '
+                             'default).')
+    parser.add_argument('--cache-file',
+                        help='File to keep the --cache in.  If not given, "squid_cache.sqlite" next to squid.py '
+                             'is used.')
+    parser.add_argument('--cache-size', type=int, default=100000,
+                        help='Maximum number of files (and of distinct structures) to keep in the --cache '
+                             '(default: 100000)')
     parser.add_argument('-o', '--output',
-                        help='File name of XLSX report (without extension) with match details.  If -o is not given, '
+                        help='File name of report (without extension) with match details.  If -o is not given, '
                              'the file will be named "SQUID Matches (YYYY-MM-DDTHH-MM-SS)".')
+    parser.add_argument('--format', choices=sorted(report_formats), default='xlsx',
+                        help='Format of the report: xlsx (default), csv, or jsonl (one JSON object per line).  The '
+                             'report is written as the scan goes, so the csv and jsonl reports can be read while it '
+                             'runs.')
+    parser.add_argument('--file-timeout', type=float, default=60,
+                        help='Most seconds reading one file\'s structure may take before it\'s given up on and '
+                             'reported as "timed out"; 0 for no limit (default: 60)')
+    parser.add_argument('--max-tables', type=int, default=5000,
+                        help='Most tables a SQLite DB may have before it\'s reported as "oversized" instead of '
+                             'compared; 0 for no limit (default: 5000)')
+    parser.add_argument('--max-columns', type=int, default=50000,
+                        help='Most columns, over all its tables, a SQLite DB may have before it\'s reported as '
+                             '"oversized" instead of compared; 0 for no limit (default: 50000)')
+    parser.add_argument('--progress', action='store_true',
+                        help='Show the progress of a --compare scan of a directory on stderr: files done, files/sec, '
+                             'ETA and the file being read.')
+    parser.add_argument('--metrics', metavar='FILE',
+                        help='Write a JSON summary of the scan to FILE when it ends: counts, times and histograms '
+                             'of each stage, and the reasons files couldn\'t be read.')
+    parser.add_argument('--profile', metavar='FILE',
+                        help='Profile the scoring of the scan with cProfile and write the stats to FILE (each '
+                             'worker process writes to FILE.PID).')
 
     args = vars(parser.parse_args())
+    if args['top'] < 1:
+        parser.error('--top must be at least 1')
+    for option in ['file_timeout', 'max_tables', 'max_columns']:
+        if args[option] < 0:
+            parser.error('--{} must be 0 (no limit) or more'.format(option.replace('_', '-')))
     if not args['name']:
         args['name'] = args['learn']
     if not args['name'] and not args['learn']:
         args['name'] = args['compare']
+    if not args['cache_file']:
+        args['cache_file'] = os.path.join(os.path.dirname(os.path.realpath(sys.argv[0])), 'squid_cache.sqlite')
     if not args['output']:
         args['output'] = "SQUID Matches ({})".format(time.strftime('%Y-%m-%dT%H-%M-%S'))
     return args
@@ -478,36 +3409,99 @@ def main():
     print " SQUID v{} - SQLite Unknown Identifier".format(__version__)
     print '-' * 78 + '\n'
 
-    if args['compare']:
-        global results
-        results = []
-        short_columns = "{:>25}  {:>5}%  {:<25} {:<18}"
+    catalog_path = os.path.join(os.path.dirname(os.path.realpath(sys.argv[0])), 'catalog.sqlite')
+    prefilter = (args['lsh_bands'], args['lsh_rows']) if args['prefilter'] else None
+    limits = FileLimits(args['file_timeout'], args['max_tables'], args['max_columns'])
 
+    if args['compare']:
         if os.path.isdir(str(args['compare']).rstrip(os.sep)):
             print textwrap.fill("Scanning {} and any subdirectories for SQLite DBs.\n".format(args['compare']),
                                 width=75, initial_indent=" ", subsequent_indent=" ")
             print "\n"
-            print textwrap.fill("Below are any high-confidence (90+%) matches; a complete list of the top three matches"
-                                " for each SQLite DB is in \"{}.xlsx\".".format(args['output']), width=75,
+            report = report_formats[args['format']](args['output'], args['top'])
+            cache_path = None
+            if args['cache'] != 'bypass':
+                cache_path = args['cache_file']
+                # Set up (or clear) the cache before any workers open it
+                cache = ScanCache(cache_path)
+                if args['cache'] == 'rebuild':
+                    cache.clear()
+                cache.close()
+            rejections = collections.Counter()
+            start_scan_metrics(args['profile'])
+            progress = ProgressReporter(args['compare']) if args['progress'] else None
+            if progress:
+                progress.start()
+            try:
+                report_results(compare_directory(args['compare'], catalog_path, args['jobs'], rejections, cache_path,
+                                                 args['top'], prefilter, limits, args['fuzzy']),
+                               report, args['top'])
+            finally:
+                if progress:
+                    progress.stop()
+            finish_scan_metrics(args['metrics'])
+            if rejections:
+                print
+                print textwrap.fill("Skipped {} files without a SQLite header ({}).".format(
+                    sum(rejections.values()), ', '.join('{} {}'.format(count, reason) for reason, count in
+                                                        sorted(rejections.items()))),
+                    width=75, initial_indent=" ", subsequent_indent=" ")
+            if scan_metrics.counters['timed out'] or scan_metrics.counters['oversized']:
+                print
+                print textwrap.fill("{} files timed out and {} were oversized; they are marked in the report's "
+                                    "Status column.".format(scan_metrics.counters['timed out'],
+                                                            scan_metrics.counters['oversized']),
+                                    width=75, initial_indent=" ", subsequent_indent=" ")
+            if cache_path:
+                open_scan_cache(cache_path).evict(args['cache_size'])
+            print
+            print textwrap.fill("Match details were written to \"{}\".".format(report.path), width=75,
                                 initial_indent=" ", subsequent_indent=" ")
-            print "\n"
-            print '-' * 78
-            print(short_columns.format('Candidate SQLite DB', 'Match', 'Known DB Name', 'Known Program'))
-            print '-' * 78
-            os.path.walk(args['compare'], compare_each, 'catalog.sqlite')
-            print '-' * 78
-            write_xlsx(args['output'])
         else:
             print "Comparing {} to known SQLite DBs.\n".format(args['compare'])
             print '-' * 78
-            print(short_columns.format('Candidate SQLite DB', 'Match', 'DB Name', 'Program'))
+            print(SHORT_COLUMNS.format('Candidate SQLite DB', 'Match', 'DB Name', 'Program'))
             print '-' * 78
             candidate_db = squid(args['name'], path=args['compare'])
-            candidate_db.build_structure()
-            catalog_path = os.path.join(os.path.dirname(os.path.realpath(sys.argv[0])), 'catalog.sqlite')
-            compare_to_known(candidate_db, catalog_path)
+            candidate_db.build_structure(limits)
+            if candidate_db.limit_exceeded:
+                print " {} is {}; it wasn't compared.".format(args['compare'], candidate_db.limit_exceeded)
+            else:
+                compare_to_known(candidate_db, load_catalog(catalog_path, prefilter, args['fuzzy']), top=args['top'])
             print '-' * 78 + '\n'
 
+    elif args['carve']:
+        if os.path.isdir(str(args['carve']).rstrip(os.sep)):
+            image_paths = walk_files(args['carve'])
+        else:
+            image_paths = [args['carve']]
+        print textwrap.fill("Searching {} for embedded SQLite DBs.\n".format(args['carve']),
+                            width=75, initial_indent=" ", subsequent_indent=" ")
+        print "\n"
+        report = report_formats[args['format']](args['output'], args['top'])
+        rejections = collections.Counter()
+        start_scan_metrics(args['profile'])
+        report_results((file_result for image_path in image_paths
+                        for file_result in compare_image(image_path, catalog_path, rejections, args['top'],
+                                                         prefilter, args['fuzzy'])),
+                       report, args['top'])
+        finish_scan_metrics(args['metrics'])
+        if rejections:
+            print
+            print textwrap.fill("Skipped {} SQLite headers that couldn't be read ({}).".format(
+                sum(rejections.values()), ', '.join('{} {}'.format(count, reason) for reason, count in
+                                                    sorted(rejections.items()))),
+                width=75, initial_indent=" ", subsequent_indent=" ")
+        print
+        print textwrap.fill("Match details were written to \"{}\".".format(report.path), width=75,
+                            initial_indent=" ", subsequent_indent=" ")
+
+    elif args['serve']:
+        print textwrap.fill("Serving compare requests on {}; press Ctrl-C to stop.".format(args['serve']),
+                            width=75, initial_indent=" ", subsequent_indent=" ")
+        serve(args['serve'], CompareService(catalog_path, args['jobs'], args['top'], prefilter, limits,
+                                            args['fuzzy']))
+
     elif args['learn']:
         if os.path.isdir(str(args['learn']).rstrip(os.sep)):
             print textwrap.fill("Scanning {} for SQLite DBs.\n".format(args['learn']),
@@ -520,6 +3514,35 @@ def main():
             print
             learn_db(args['name'], args['learn'], args['family'], args['program'], args['version'])
 
+        # Bring the compiled catalog up to date with what was learned
+        compile_catalog(catalog_path)
+
+    elif args['learn_batch']:
+        print textwrap.fill("Learning the SQLite DBs in {}.\n".format(args['learn_batch']),
+                            width=75, initial_indent=" ", subsequent_indent=" ")
+        print
+        outcomes = learn_batch(args['learn_batch'], catalog_path, args['family'], args['program'], args['version'],
+                               args['duplicates'], args['jobs'])
+        not_learned = dict((reason, count) for reason, count in outcomes.items()
+                           if reason not in ('learned', 'merged', 'skipped', 'already known'))
+        print textwrap.fill("Learned {} new, merged {}, skipped {}, already known {}; not learned {}{}.".format(
+            outcomes['learned'], outcomes['merged'], outcomes['skipped'], outcomes['already known'],
+            sum(not_learned.values()),
+            ' ({})'.format(', '.join('{} {}'.format(count, reason) for reason, count in sorted(not_learned.items())))
+            if not_learned else ''), width=75, initial_indent=" ", subsequent_indent=" ")
+        compile_catalog(catalog_path)
+
+    elif args['merge_catalog']:
+        print textwrap.fill("Merging {} into the catalog.\n".format(args['merge_catalog']),
+                            width=75, initial_indent=" ", subsequent_indent=" ")
+        print
+        outcomes = merge_catalog(args['merge_catalog'], catalog_path)
+        print textwrap.fill("Added {} new entries, merged versions into {}, already known {}; {} entries are only in "
+                            "this catalog.".format(outcomes['added'], outcomes['merged'], outcomes['already known'],
+                                                   outcomes['only in this catalog']),
+                            width=75, initial_indent=" ", subsequent_indent=" ")
+        compile_catalog(catalog_path)
+
 
 if __name__ == "__main__":
     main()
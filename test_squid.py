@@ -0,0 +1,495 @@
+#!/usr/bin/env python
+
+import hashlib
+import json
+import os
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import unittest
+import StringIO
+
+import squid
+from benchmark import mutate_structure
+
+CATALOG_PATH = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'catalog.sqlite')
+
+
+def create_database(path, statements, pragmas=()):
+    db = sqlite3.connect(path)
+    for pragma in pragmas:
+        db.execute(pragma)
+    for statement in statements:
+        db.execute(statement)
+    db.commit()
+    db.close()
+    return path
+
+
+def exhaustive_rankings(candidate, known_catalog, top):
+    """Rank every catalog entry with compare_dbs, as (score, position) pairs; ties go to the earliest entry."""
+    scores = [(float(squid.compare_dbs(candidate, known_squid)[2]), -position)
+              for position, known_squid in enumerate(known_catalog)]
+    return [(score, -negative_position) for score, negative_position in sorted(scores, reverse=True)[:top]]
+
+
+class PrunedRankingTest(unittest.TestCase):
+    """The pruned and batched rankings must match scoring every catalog entry, on the shipped catalog."""
+
+    @classmethod
+    def setUpClass(cls):
+        # Work on a copy, so the compiled catalog written next to it doesn't touch the shipped one
+        cls.directory = tempfile.mkdtemp(prefix='squid-test-')
+        catalog_path = os.path.join(cls.directory, 'catalog.sqlite')
+        shutil.copyfile(CATALOG_PATH, catalog_path)
+        cls.known_catalog = squid.Catalog(catalog_path)
+
+        # Each entry's own structure, and a few copies of it with tables and columns dropped, added or retyped
+        rng = random.Random(1)
+        cls.candidates = []
+        for known_squid in cls.known_catalog:
+            for mutation_rate in [0, 0.1, 0.3, 0.6]:
+                structure = mutate_structure(known_squid.structure, rng, mutation_rate)
+                if structure:
+                    cls.candidates.append(squid.squid(known_squid.db_name, structure=structure))
+        cls.expected_rankings = [exhaustive_rankings(candidate, cls.known_catalog, 10) for candidate in cls.candidates]
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.directory, ignore_errors=True)
+
+    def rankings(self, matches):
+        return [(match['score'], self.known_catalog.positions[match['squid'].squid_id]) for match in matches]
+
+    def test_compare_to_known_matches_exhaustive(self):
+        for top in [1, 3, 10]:
+            for candidate, expected_rankings in zip(self.candidates, self.expected_rankings):
+                matches = squid.compare_to_known(candidate, self.known_catalog, verbose=False, top=top)
+                self.assertEqual(self.rankings(matches), expected_rankings[:top])
+
+    def test_compare_batch_matches_exhaustive(self):
+        batch_scores = squid.compare_batch(self.candidates, self.known_catalog)
+        for candidate, scores, expected_rankings in zip(self.candidates, batch_scores, self.expected_rankings):
+            matches = squid.compare_to_known(candidate, self.known_catalog, scores, verbose=False)
+            self.assertEqual(self.rankings(matches), expected_rankings[:3])
+
+    def test_exact_hits_fill_rankings(self):
+        # Structures identical to catalog entries rank those entries first, then the rest as usual
+        exact_candidates = [squid.squid(known_squid.db_name, structure=known_squid.structure)
+                            for known_squid in self.known_catalog if known_squid.structure]
+        for top in [1, 3]:
+            results = squid.rank_candidates(exact_candidates, self.known_catalog, top=top)
+            for candidate, result in zip(exact_candidates, results):
+                self.assertEqual(self.rankings(result['matches']),
+                                 exhaustive_rankings(candidate, self.known_catalog, top))
+
+    def test_result_summary_leaves_out_non_matches(self):
+        # A structure sharing no tables with the catalog scores 0 against every entry
+        candidate = squid.squid('unknown.db', path='unknown.db',
+                                structure={'squid_test_unknown': {'id': {'type': 'INTEGER', 'not_null': 0,
+                                                                         'default_value': None}}})
+        result = squid.rank_candidates([candidate], self.known_catalog)[0]
+        self.assertEqual([match['score'] for match in result['matches']], [0.0] * 3)
+        self.assertEqual(squid.result_summary(result)['matches'], [])
+
+    def test_compiled_catalog_matches_sqlite(self):
+        parsed_catalog = squid.Catalog(self.known_catalog.path, use_compiled=False)
+        compiled_catalog = squid.Catalog(self.known_catalog.path)
+        for candidate in self.candidates[::7]:
+            self.assertEqual(self.rankings(squid.compare_to_known(candidate, compiled_catalog, verbose=False)),
+                             self.rankings(squid.compare_to_known(candidate, parsed_catalog, verbose=False)))
+
+
+# CREATE statements covering the SQL parse_create_table has to read as SQLite does
+CREATE_STATEMENTS = [
+    # Quoted names, and types as written
+    'CREATE TABLE "quoted ""name"""([a b] INTEGER, `c``d` varchar(255), \'e\' DOUBLE PRECISION, f UNSIGNED BIG INT, '
+    'g, "h" "quoted type", i int)',
+    # DEFAULT forms
+    "CREATE TABLE defaults(a TEXT DEFAULT 'it''s', b INT DEFAULT -1, c REAL DEFAULT +5.0e3, d DEFAULT NULL, "
+    "e DEFAULT CURRENT_TIMESTAMP, f DEFAULT (1 + (2 * 3)), g BLOB DEFAULT x'00ff', h DEFAULT TRUE, "
+    "i TEXT NOT NULL DEFAULT '', j DEFAULT 0x1F)",
+    # Column and table constraints, comments and constraint names
+    'CREATE TABLE constraints(a INTEGER PRIMARY KEY AUTOINCREMENT, b TEXT NOT NULL UNIQUE COLLATE NOCASE, '
+    'c INT CONSTRAINT positive CHECK (c > 0) REFERENCES defaults(b) ON DELETE SET DEFAULT, '
+    'd /* a ( comment */ TEXT -- and another (\n, CONSTRAINT u UNIQUE (b, c), FOREIGN KEY (d) REFERENCES x(y))',
+    # WITHOUT ROWID tables make their primary key columns NOT NULL
+    'CREATE TABLE without_rowid(a TEXT, b INT, c, PRIMARY KEY (a, b DESC)) WITHOUT ROWID',
+    'CREATE TABLE without_rowid_column(a TEXT PRIMARY KEY, b) WITHOUT ROWID',
+    # Generated columns aren't listed by PRAGMA table_info
+    'CREATE TABLE generated(a INT, b INT GENERATED ALWAYS AS (a * 2) STORED, c AS (a + 1), d TEXT)',
+    # Virtual tables, and the shadow tables (some WITHOUT ROWID) they create
+    'CREATE VIRTUAL TABLE fts4_table USING fts4(title, body, tokenize=porter)',
+    'CREATE VIRTUAL TABLE fts5_table USING fts5(title, body UNINDEXED)',
+    'CREATE VIRTUAL TABLE rtree_table USING rtree(id, min_x, max_x, +label TEXT)',
+    'CREATE VIRTUAL TABLE "rtree i32" USING rtree_i32(id, min_x, max_x, min_y, max_y)',
+    # A statement too long for one page, so it's read from overflow pages
+    'CREATE TABLE overflow({})'.format(', '.join('column_with_a_long_name_{} VARCHAR(64) NOT NULL DEFAULT '
+                                                 '\'value {}\''.format(number, number) for number in range(150))),
+]
+
+
+class TemporaryDirectoryTest(unittest.TestCase):
+    """Gives each test a temporary directory to create databases and catalogs in."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='squid-test-')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def create_database(self, name, statements, pragmas=()):
+        return create_database(os.path.join(self.directory, name), statements, pragmas)
+
+
+class RawDatabaseTest(TemporaryDirectoryTest):
+    """Structures read from a database's pages must equal the ones SQLite gives build_structure."""
+
+    def assert_raw_structure_matches(self, path):
+        candidate = squid.squid(path=path)
+        candidate.build_structure()
+        self.assertFalse(candidate.partial)
+        with open(path, 'rb') as database_file:
+            raw_structure = squid.RawDatabase(database_file.read()).structure()
+        self.assertEqual(raw_structure, candidate.structure)
+        return raw_structure
+
+    def test_create_statements(self):
+        path = self.create_database('statements.sqlite', CREATE_STATEMENTS)
+        structure = self.assert_raw_structure_matches(path)
+        self.assertEqual(len(structure['overflow']), 150)
+        self.assertNotIn('b', structure['generated'])
+
+    def test_small_pages_and_utf16(self):
+        # Small pages spread sqlite_master over interior and overflow pages
+        tables = ['CREATE TABLE table_{}(a INTEGER, b TEXT DEFAULT \'b\')'.format(number) for number in range(200)]
+        path = self.create_database('small_pages.sqlite', CREATE_STATEMENTS + tables, ['PRAGMA page_size = 512'])
+        self.assertTrue(all('table_{}'.format(number) in self.assert_raw_structure_matches(path)
+                            for number in range(200)))
+        path = self.create_database('utf16.sqlite', CREATE_STATEMENTS[:6], ['PRAGMA encoding = "UTF-16le"'])
+        self.assert_raw_structure_matches(path)
+
+    def test_truncated_statements(self):
+        # Garbled statements, as in a damaged schema, never raise; a table that can't be parsed keeps its name
+        statement = 'CREATE TABLE t(a INT, PRIMARY KEY (a))'
+        for end in range(len(statement) + 1):
+            squid.parse_create_table(statement[:end])
+        records = [('table', 'good', 'good', 2, 'CREATE TABLE good(a INT)'),
+                   ('table', 'garbled', 'garbled', 3, 'CREATE TABLE garbled(a, PRIMARY KEY')]
+        self.assertEqual(sorted(squid.structure_from_schema(records)), ['garbled', 'good'])
+
+
+# Enough tables that sqlite_master outgrows page 1, which becomes an interior page over leaf pages holding the schema
+SCHEMA_STATEMENTS = ["CREATE TABLE table_{}(id INTEGER PRIMARY KEY, name TEXT NOT NULL DEFAULT 'unnamed', value REAL, "
+                     "notes VARCHAR(255) DEFAULT NULL)".format(number) for number in range(60)]
+
+
+class RecoveryTest(TemporaryDirectoryTest):
+    """Damaged databases get the schema recovered from their pages, marked partial, and are never learned."""
+
+    def setUp(self):
+        TemporaryDirectoryTest.setUp(self)
+        path = self.create_database('intact.sqlite', SCHEMA_STATEMENTS + [
+            "INSERT INTO table_0 (name) VALUES ('{}')".format('x' * 500)] * 200)
+        intact = squid.squid(path=path)
+        intact.build_structure()
+        self.structure = intact.structure
+        with open(path, 'rb') as database_file:
+            data = database_file.read()
+        self.page_size = 4096
+
+        # Page 1 wiped apart from the database header, and the file cut off just past its schema and root pages
+        self.damaged_paths = [os.path.join(self.directory, name) for name in ['page_1.sqlite', 'truncated.sqlite']]
+        with open(self.damaged_paths[0], 'wb') as damaged_file:
+            damaged_file.write(data[:squid.SQLITE_HEADER_SIZE] + '\x00' * (self.page_size - squid.SQLITE_HEADER_SIZE) +
+                               data[self.page_size:])
+        last_root_page = max(record[3] for record in squid.RawDatabase(data).table_records(1))
+        with open(self.damaged_paths[1], 'wb') as damaged_file:
+            damaged_file.write(data[:(last_root_page + 1) * self.page_size])
+        self.assertLess(os.path.getsize(self.damaged_paths[1]), len(data))
+
+    def test_damaged_databases_are_partial(self):
+        for path in self.damaged_paths:
+            candidate = squid.squid(path=path)
+            candidate.build_structure()
+            self.assertTrue(candidate.partial)
+            self.assertEqual(candidate.structure, self.structure)
+
+            # A limited extraction recovers the same
+            self.assertEqual(squid.extract_structure(path, squid.FileLimits(30))[:3],
+                             (self.structure, None, True))
+
+    def test_learn_db_refuses_partial(self):
+        catalog_path = os.path.join(self.directory, 'catalog.sqlite')
+        # learn_db writes to the catalog next to the script it's run as
+        argv, stdout = sys.argv[0], sys.stdout
+        sys.argv[0], sys.stdout = os.path.join(self.directory, 'squid.py'), StringIO.StringIO()
+        try:
+            for path in self.damaged_paths:
+                squid.learn_db(os.path.basename(path), path, 'Test', 'Test', '1')
+            output = sys.stdout.getvalue()
+        finally:
+            sys.argv[0], sys.stdout = argv, stdout
+        self.assertFalse(os.path.exists(catalog_path))
+        self.assertEqual(output.count('could only be partly recovered'), 2)
+
+    def test_learn_batch_refuses_partial(self):
+        catalog_path = os.path.join(self.directory, 'catalog.sqlite')
+        outcomes = squid.learn_batch(self.directory, catalog_path, 'Test', 'Test', '1')
+        self.assertEqual(outcomes, {'learned': 1, 'damaged': 2})
+        db = sqlite3.connect(catalog_path)
+        self.assertEqual(db.execute('SELECT db_name FROM known_databases').fetchall(), [('intact.sqlite',)])
+        db.close()
+
+
+def create_catalog(path, entries):
+    """Create a catalog at path of (program_name, versions, db_name, structure JSON) entries, all family Test."""
+    db = sqlite3.connect(path)
+    with db:
+        cursor = db.cursor()
+        squid.create_known_databases(cursor)
+        cursor.executemany("INSERT INTO known_databases VALUES ('Test', ?, ?, ?, ?, ?)",
+                           [(program_name, json.dumps(versions), db_name, structure,
+                             hashlib.md5(structure).hexdigest()) for program_name, versions, db_name, structure in entries])
+    db.close()
+    return path
+
+
+def catalog_entries(path):
+    db = sqlite3.connect(path)
+    try:
+        return [(program_name, json.loads(versions), db_name) for program_name, versions, db_name in db.execute(
+            "SELECT program_name, program_version, db_name FROM known_databases ORDER BY rowid")]
+    finally:
+        db.close()
+
+
+# The same structure as JSON with its keys in two different orders
+MESSAGES = '{"messages": {"id": {"type": "INTEGER", "not_null": 0, "default_value": null}}}'
+MESSAGES_REORDERED = '{"messages": {"id": {"default_value": null, "not_null": 0, "type": "INTEGER"}}}'
+CONTACTS = '{"contacts": {"name": {"type": "TEXT", "not_null": 1, "default_value": null}}}'
+
+
+class MergeCatalogTest(TemporaryDirectoryTest):
+    """merge_catalog matches entries by structure and program, and merges their versions."""
+
+    def setUp(self):
+        TemporaryDirectoryTest.setUp(self)
+        self.catalog_path = create_catalog(os.path.join(self.directory, 'catalog.sqlite'), [
+            ('Chat', ['1', '2'], 'chat.db', MESSAGES),
+            ('Phone', ['10'], 'contacts.db', CONTACTS)])
+
+    def merge(self, entries):
+        other_path = create_catalog(os.path.join(self.directory, 'other.sqlite'), entries)
+        return squid.merge_catalog(other_path, self.catalog_path)
+
+    def test_key_order(self):
+        outcomes = self.merge([('Chat', ['3'], 'chat.db', MESSAGES_REORDERED)])
+        self.assertEqual(outcomes, {'merged': 1, 'only in this catalog': 1})
+        self.assertEqual(catalog_entries(self.catalog_path), [('Chat', ['1', '2', '3'], 'chat.db'),
+                                                              ('Phone', ['10'], 'contacts.db')])
+
+    def test_already_known(self):
+        outcomes = self.merge([('Chat', ['2'], 'chat.db', MESSAGES_REORDERED), ('Phone', ['10'], 'contacts.db', CONTACTS)])
+        self.assertEqual(outcomes, {'already known': 2, 'only in this catalog': 0})
+        self.assertEqual(catalog_entries(self.catalog_path), [('Chat', ['1', '2'], 'chat.db'),
+                                                              ('Phone', ['10'], 'contacts.db')])
+
+    def test_repeated_in_other_catalog(self):
+        # Added once with both entries' versions, sorted numerically; a known structure for another program is added
+        outcomes = self.merge([('Mail', ['9'], 'mail.db', MESSAGES), ('Mail', ['10', '9'], 'mail.db', MESSAGES_REORDERED),
+                               ('Chat', ['2', '4'], 'chat.db', MESSAGES), ('Chat', ['3'], 'chat.db', MESSAGES)])
+        self.assertEqual(outcomes, {'added': 1, 'merged': 3, 'only in this catalog': 1})
+        self.assertEqual(catalog_entries(self.catalog_path), [('Chat', ['1', '2', '3', '4'], 'chat.db'),
+                                                              ('Phone', ['10'], 'contacts.db'),
+                                                              ('Mail', ['9', '10'], 'mail.db')])
+
+    def test_single_transaction(self):
+        # An addition that fails must take the other entry's merged versions with it
+        db = sqlite3.connect(self.catalog_path)
+        db.execute("CREATE TRIGGER refuse BEFORE INSERT ON known_databases WHEN NEW.db_name = 'refused.db' "
+                   "BEGIN SELECT RAISE(ABORT, 'refused'); END")
+        db.commit()
+        db.close()
+        with self.assertRaises(sqlite3.IntegrityError):
+            self.merge([('Chat', ['3'], 'chat.db', MESSAGES), ('Mail', ['1'], 'refused.db', CONTACTS)])
+        self.assertEqual(catalog_entries(self.catalog_path), [('Chat', ['1', '2'], 'chat.db'),
+                                                              ('Phone', ['10'], 'contacts.db')])
+
+
+
+class LearnBatchTest(TemporaryDirectoryTest):
+    """learn_batch handles structures seen before by the duplicates policy, and counts why DBs weren't learned."""
+
+    def setUp(self):
+        TemporaryDirectoryTest.setUp(self)
+        statements = ['CREATE TABLE messages(id INTEGER PRIMARY KEY, body TEXT)']
+        for name in ['chat_1.sqlite', 'chat_2.sqlite', 'chat_2_again.sqlite', 'mail.sqlite']:
+            self.create_database(name, statements)
+        self.create_database('no_tables.sqlite', [], ['PRAGMA user_version = 1'])
+        with open(os.path.join(self.directory, 'notes.txt'), 'wb') as notes_file:
+            notes_file.write('Not a database, but long enough to have a header of one.\n' * 4)
+
+        # The same structure for two versions of one program (one of them twice) and for another program
+        self.manifest_path = os.path.join(self.directory, 'manifest.json')
+        with open(self.manifest_path, 'wb') as manifest_file:
+            json.dump([{'path': 'chat_1.sqlite', 'program': 'Chat', 'version': '1'},
+                       {'path': 'chat_2.sqlite', 'program': 'Chat', 'version': '2'},
+                       {'path': 'chat_2_again.sqlite', 'program': 'Chat', 'version': '2'},
+                       {'path': 'mail.sqlite', 'program': 'Mail', 'version': '10'},
+                       {'path': 'no_tables.sqlite'}, {'path': 'notes.txt'}, {'path': 'missing.sqlite'}],
+                      manifest_file)
+        self.catalog_path = os.path.join(self.directory, 'catalog.sqlite')
+        self.reasons = {'no tables': 1, 'not SQLite': 1, 'unreadable': 1}
+
+    def learn(self, duplicates, jobs=1):
+        return squid.learn_batch(self.manifest_path, self.catalog_path, 'Test', 'Other', '0', duplicates, jobs)
+
+    def test_merge(self):
+        self.assertEqual(self.learn('merge'), dict(self.reasons, learned=2, merged=1, **{'already known': 1}))
+        self.assertEqual(catalog_entries(self.catalog_path), [('Chat', ['1', '2'], 'chat_1.sqlite'),
+                                                              ('Mail', ['10'], 'mail.sqlite')])
+        # Learning them again changes nothing, with or without workers
+        self.assertEqual(self.learn('merge', jobs=2), dict(self.reasons, **{'already known': 4}))
+        self.assertEqual(len(catalog_entries(self.catalog_path)), 2)
+
+    def test_new(self):
+        self.assertEqual(self.learn('new'), dict(self.reasons, learned=4))
+        self.assertEqual(catalog_entries(self.catalog_path), [('Chat', ['1'], 'chat_1.sqlite'),
+                                                              ('Chat', ['2'], 'chat_2.sqlite'),
+                                                              ('Chat', ['2'], 'chat_2_again.sqlite'),
+                                                              ('Mail', ['10'], 'mail.sqlite')])
+
+    def test_skip(self):
+        self.assertEqual(self.learn('skip'), dict(self.reasons, learned=1, skipped=3))
+        self.assertEqual(catalog_entries(self.catalog_path), [('Chat', ['1'], 'chat_1.sqlite')])
+
+    def test_learn_db_indexes_catalog(self):
+        argv, stdout = sys.argv[0], sys.stdout
+        sys.argv[0], sys.stdout = os.path.join(self.directory, 'squid.py'), StringIO.StringIO()
+        try:
+            squid.learn_db('chat_1.sqlite', os.path.join(self.directory, 'chat_1.sqlite'), 'Test', 'Chat', '1')
+        finally:
+            sys.argv[0], sys.stdout = argv, stdout
+        db = sqlite3.connect(self.catalog_path)
+        self.assertEqual(db.execute("SELECT name FROM sqlite_master WHERE type = 'index'").fetchall(),
+                         [('known_databases_structure_md5',)])
+        db.close()
+
+
+
+class ScanCacheTest(TemporaryDirectoryTest):
+    """Cached structures and rankings must give the same results as a scan without the cache."""
+
+    def setUp(self):
+        TemporaryDirectoryTest.setUp(self)
+        self.cache = squid.ScanCache(os.path.join(self.directory, 'cache.sqlite'))
+        squid.ranked_structures.clear()
+
+    def tearDown(self):
+        self.cache.close()
+        squid.ranked_structures.clear()
+        TemporaryDirectoryTest.tearDown(self)
+
+    def test_changed_files_are_extracted_again(self):
+        path = self.create_database('messages.sqlite', ['CREATE TABLE messages(id INTEGER PRIMARY KEY, body TEXT)'])
+        catalog = squid.Catalog(create_catalog(os.path.join(self.directory, 'catalog.sqlite'),
+                                               [('Chat', ['1'], 'chat.db', MESSAGES)]))
+        structure = squid.extract_structure(path)[0]
+        stale_structure = {'stale': {'id': {'type': 'INTEGER', 'not_null': 0, 'default_value': None}}}
+
+        def scanned_structure_md5():
+            return squid.compare_files([path], catalog, cache=self.cache)[0]['structure_md5']
+
+        def change_size():
+            with open(path, 'ab') as database_file:
+                database_file.write('\x00' * 4096)
+
+        def change_mtime():
+            stat = os.stat(path)
+            os.utime(path, (stat.st_atime, stat.st_mtime + 10))
+
+        def change_inode():
+            # A copy with the same size and mtime moved into its place
+            shutil.copy2(path, path + '.new')
+            os.rename(path + '.new', path)
+
+        for change in [change_size, change_mtime, change_inode]:
+            self.cache.put_structure(path, squid.file_identity(path), stale_structure)
+            self.assertEqual(scanned_structure_md5(), squid.structure_hash(stale_structure))
+            identity = squid.file_identity(path)
+            change()
+            self.assertNotEqual(squid.file_identity(path), identity)
+            self.assertEqual(scanned_structure_md5(), squid.structure_hash(structure))
+
+    def test_rankings_after_catalog_additions(self):
+        # The catalog without its last 20 entries, which are added back once its rankings are cached
+        catalog_path = os.path.join(self.directory, 'catalog.sqlite')
+        shutil.copyfile(CATALOG_PATH, catalog_path)
+        db = sqlite3.connect(catalog_path)
+        with db:
+            rows = db.execute("SELECT * FROM known_databases ORDER BY rowid").fetchall()
+            db.execute("DELETE FROM known_databases WHERE rowid IN "
+                       "(SELECT rowid FROM known_databases ORDER BY rowid DESC LIMIT 20)")
+        db.close()
+
+        rng = random.Random(2)
+        candidates = [squid.squid(db_name, structure=mutate_structure(json.loads(structure), rng, 0.2))
+                      for program_family, program_name, program_version, db_name, structure, structure_md5 in rows]
+        candidates = [candidate for candidate in candidates if candidate.structure]
+        for top in [1, 3]:
+            squid.rank_candidates(candidates, squid.Catalog(catalog_path), self.cache, top)
+        scored_entries = len(rows) - 20
+
+        db = sqlite3.connect(catalog_path)
+        with db:
+            db.executemany("INSERT INTO known_databases VALUES (?, ?, ?, ?, ?, ?)", rows[-20:])
+        db.close()
+        known_catalog = squid.Catalog(catalog_path)
+        squid.ranked_structures.clear()
+
+        for top in [1, 3]:
+            # Only the added entries are scored for the cached rankings
+            self.assertEqual(self.cache.get_matches(squid.structure_hash(candidates[0].structure), known_catalog,
+                                                    top)[1], scored_entries)
+            results = squid.rank_candidates(candidates, known_catalog, self.cache, top)
+            squid.ranked_structures.clear()
+            for candidate, result in zip(candidates, results):
+                self.assertEqual([(match['score'], match['squid'].squid_id) for match in result['matches']],
+                                 [(match['score'], match['squid'].squid_id) for match in
+                                  squid.compare_to_known(candidate, known_catalog, verbose=False, top=top)])
+
+
+
+class ParseArgsTest(unittest.TestCase):
+    """Options that can't be used are rejected before anything is read."""
+
+    def parse_args(self, *arguments):
+        argv, stdout, stderr = sys.argv, sys.stdout, sys.stderr
+        sys.argv, sys.stdout, sys.stderr = ['squid.py', '-c', 'unknown.db'] + list(arguments), \
+            StringIO.StringIO(), StringIO.StringIO()
+        try:
+            return squid.parse_args()
+        finally:
+            self.errors = sys.stderr.getvalue()
+            sys.argv, sys.stdout, sys.stderr = argv, stdout, stderr
+
+    def test_top(self):
+        self.assertEqual(self.parse_args('--top', '1')['top'], 1)
+        for top in ['0', '-3']:
+            with self.assertRaises(SystemExit):
+                self.parse_args('--top', top)
+            self.assertIn('--top must be at least 1', self.errors)
+
+    def test_limits(self):
+        for option in ['--file-timeout', '--max-tables', '--max-columns']:
+            self.assertEqual(self.parse_args(option, '0')[option[2:].replace('-', '_')], 0)
+            with self.assertRaises(SystemExit):
+                self.parse_args(option, '-1')
+            self.assertIn('{} must be 0 (no limit) or more'.format(option), self.errors)
+
+
+if __name__ == '__main__':
+    unittest.main()